@@ -0,0 +1,115 @@
+// Shared by the data fix scripts, which are run through
+//
+//     ./hint data-fix [--batch-size=<n>] [--parallel=<n>] [--reset] <script>
+//
+// Rows to fix are read once, sorted by a key and split into batches,
+// which are fixed in their own transaction on one of `parallel`
+// connections. The key of the last row of each batch is written to a
+// checkpoint once that batch and every batch before it have committed,
+// so a failed or interrupted run carries on from there. Batches after
+// the checkpoint may already have been committed when a run fails, so
+// fixes must be safe to apply twice.
+
+import groovy.sql.Sql
+import java.util.concurrent.Callable
+import java.util.concurrent.Executors
+import java.util.concurrent.LinkedBlockingQueue
+import java.util.concurrent.TimeUnit
+
+class DataFix {
+    String name
+    int batchSize
+    int parallel
+    File checkpoint
+    String dbUrl
+    String dbUser
+    String dbPassword
+
+    DataFix(String name) {
+        def env = System.getenv()
+        this.name = name
+        this.batchSize = (env.DATA_FIX_BATCH_SIZE ?: "500") as int
+        this.parallel = (env.DATA_FIX_PARALLEL ?: "1") as int
+        this.dbUrl = env.DB_URL ?: "jdbc:postgresql://hint-db/hint"
+        this.dbUser = env.DB_USER ?: "hintuser"
+        this.dbPassword = env.DB_PASSWORD ?: "changeme"
+        def dir = new File(env.DATA_FIX_CHECKPOINTS ?: "checkpoints")
+        dir.mkdirs()
+        this.checkpoint = new File(dir, name)
+        if (env.DATA_FIX_RESET == "true" && this.checkpoint.exists()) {
+            println "Removing checkpoint for ${name}"
+            this.checkpoint.delete()
+        }
+    }
+
+    Sql connect() {
+        Sql.newInstance(dbUrl, dbUser, dbPassword, "org.postgresql.Driver")
+    }
+
+    // Rows that share a key are always kept in the same batch
+    void run(String query, Closure key, Closure fix) {
+        def after = checkpoint.exists() ? checkpoint.text : null
+        if (after != null) {
+            println "Resuming ${name} after '${after}'"
+        }
+        def rows
+        def sql = connect()
+        try {
+            rows = sql.rows(query)
+        } finally {
+            sql.close()
+        }
+        rows = rows.findAll { after == null || key(it) > after }
+        rows.sort { key(it) }
+        def batches = batch(rows, key)
+        println "${name}: ${rows.size()} rows in ${batches.size()} batches " +
+                "of up to ${batchSize}, ${parallel} at a time"
+
+        def connections = new LinkedBlockingQueue<Sql>()
+        parallel.times { connections.put(connect()) }
+        def pool = Executors.newFixedThreadPool(parallel)
+        def t0 = System.currentTimeMillis()
+        try {
+            def futures = batches.collect { rowsBatch ->
+                pool.submit({
+                    def con = connections.take()
+                    try {
+                        con.withTransaction { fix(con, rowsBatch) }
+                    } finally {
+                        connections.put(con)
+                    }
+                } as Callable)
+            }
+            def done = 0
+            futures.eachWithIndex { future, i ->
+                future.get()
+                done += batches[i].size()
+                checkpoint.text = key(batches[i].last())
+                def elapsed = (System.currentTimeMillis() - t0) / 1000
+                println "${name}: batch ${i + 1}/${batches.size()} " +
+                        "committed, ${done}/${rows.size()} rows, ${elapsed}s"
+            }
+        } finally {
+            pool.shutdownNow()
+            pool.awaitTermination(1, TimeUnit.MINUTES)
+            connections.each { it.close() }
+        }
+        println "${name}: done"
+    }
+
+    List<List> batch(List rows, Closure key) {
+        def ret = []
+        def current = []
+        rows.each { row ->
+            if (current.size() >= batchSize && key(row) != key(current.last())) {
+                ret << current
+                current = []
+            }
+            current << row
+        }
+        if (current) {
+            ret << current
+        }
+        ret
+    }
+}
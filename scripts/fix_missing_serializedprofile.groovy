@@ -13,53 +13,17 @@ import groovy.sql.Sql
 import org.pac4j.sql.profile.DbProfile
 import org.pac4j.core.util.serializer.ProfileServiceSerializer
 
-class Profile {
-    Object id;
-    String serializedProfile;
-    boolean updated = false;
-
-    Profile(id, serializedProfile) {
-        this.id = id
-        this.serializedProfile = serializedProfile
-    }
-
-    void serialize(ProfileServiceSerializer serializer) {
-        println "Current serializedprofile is"
-        println this.serializedProfile
-        if (this.serializedProfile?.length() > 0) {
-            println "Not updating as profile already serialized"
-            return
-        }
-        DbProfile profile = new DbProfile()
-        profile.build(this.id, ["username": this.id])
-        this.serializedProfile = serializer.encode(profile)
-        println "Updated serialized profile is"
-        println this.serializedProfile
-        this.updated = true;
-    }
-}
-
-def dbUrl      = "jdbc:postgresql://hint-db/hint"
-def dbUser     = "hintuser"
-def dbPassword = "changeme"
-def dbDriver   = "org.postgresql.Driver"
-def con = Sql.newInstance(dbUrl, dbUser, dbPassword, dbDriver)
-
-def profiles = []
-try {
-    con.eachRow("SELECT id, serializedprofile from users;") { row ->
-        profiles << new Profile(row.id, row.serializedprofile)
-    }
-    ProfileServiceSerializer serializer = new ProfileServiceSerializer(DbProfile.class)
-    def updateSql = "UPDATE users SET serializedprofile = ? where id = ?"
-    con.withTransaction {
-        profiles.each { profile ->
-            profile.serialize(serializer)
-            if (profile.updated) {
-                con.execute updateSql, [profile.serializedProfile, profile.id]
-            }
+def fix = new DataFix("fix_missing_serializedprofile")
+def query = "SELECT id FROM users " +
+        "WHERE serializedprofile IS NULL OR serializedprofile = ''"
+def updateSql = "UPDATE users SET serializedprofile = ? WHERE id = ?"
+fix.run(query, { it.id }) { Sql sql, List rows ->
+    def serializer = new ProfileServiceSerializer(DbProfile.class)
+    sql.withBatch(rows.size(), updateSql) { ps ->
+        rows.each { row ->
+            DbProfile profile = new DbProfile()
+            profile.build(row.id, ["username": row.id])
+            ps.addBatch([serializer.encode(profile), row.id])
         }
     }
-} finally {
-    con.close()
 }
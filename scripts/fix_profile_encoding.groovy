@@ -19,51 +19,17 @@ import groovy.sql.Sql
 import org.pac4j.sql.profile.DbProfile
 import org.pac4j.core.util.serializer.ProfileServiceSerializer
 
-class Profile {
-    String id;
-    String serializedProfile;
-    boolean updated = false;
-
-    Profile(id, serializedProfile) {
-        this.id = id
-        this.serializedProfile = serializedProfile
-    }
-
-    void recode(ProfileServiceSerializer serializer) {
-        println this.serializedProfile
-        if (this.serializedProfile.startsWith("{")) {
-            println "Not migrating as already in JSON format"
-            return
-        }
-        DbProfile decoded = serializer.decode(this.serializedProfile)
-        this.serializedProfile = serializer.encode(decoded)
-        println "Migrated to JSON format"
-        println this.serializedProfile
-        this.updated = true;
-    }
-}
-
-def dbUrl      = "jdbc:postgresql://hint-db/hint"
-def dbUser     = "hintuser"
-def dbPassword = "changeme"
-def dbDriver   = "org.postgresql.Driver"
-def con = Sql.newInstance(dbUrl, dbUser, dbPassword, dbDriver)
-
-def profiles = []
-try {
-    con.eachRow("SELECT id, serializedprofile from users;") { row ->
-        profiles << new Profile(row.id, row.serializedprofile)
-    }
-    ProfileServiceSerializer serializer = new ProfileServiceSerializer(DbProfile.class)
-    def updateSql = "UPDATE users SET serializedprofile = ? where id = ?"
-    con.withTransaction {
-        profiles.each { profile ->
-            profile.recode(serializer)
-            if (profile.updated) {
-                con.execute updateSql, [profile.serializedProfile, profile.id]
-            }
+// Already migrated profiles are JSON, so are filtered out in the query
+def fix = new DataFix("fix_profile_encoding")
+def query = "SELECT id, serializedprofile FROM users " +
+        "WHERE serializedprofile NOT LIKE '{%'"
+def updateSql = "UPDATE users SET serializedprofile = ? WHERE id = ?"
+fix.run(query, { it.id }) { Sql sql, List rows ->
+    def serializer = new ProfileServiceSerializer(DbProfile.class)
+    sql.withBatch(rows.size(), updateSql) { ps ->
+        rows.each { row ->
+            DbProfile decoded = serializer.decode(row.serializedprofile)
+            ps.addBatch([serializer.encode(decoded), row.id])
         }
     }
-} finally {
-    con.close()
 }
@@ -7,57 +7,41 @@
 @Grab(group='ch.qos.logback', module='logback-classic', version='1.0.13')
 import groovy.sql.Sql
 
-class Profile {
-    def con;
-    String old_id;
-    String new_id;
-
-    Profile(con, id) {
-        this.con = con
-        this.old_id = id
-        this.new_id = this.old_id.toLowerCase()
-    }
-
-    void migrate() {
-        if (this.con.firstRow('SELECT count(*) as cnt FROM users WHERE id =:id', id:new_id)?.cnt > 0) {
-            println "Not migrating " + this.old_id + " as account already exists for id " + this.new_id
-            return
+// Each batch is moved with one statement per table, joining on the
+// (old, new) id pairs passed in as arrays. Ids that only differ in
+// case share a key, so they land in the same batch and only the
+// first of them is migrated.
+def migrateSql = [
+    "INSERT INTO users (id, username) SELECT new_id, new_id FROM unnest(?::text[], ?::text[]) AS m(old_id, new_id)",
+    "UPDATE user_session SET user_id = m.new_id FROM unnest(?::text[], ?::text[]) AS m(old_id, new_id) WHERE user_id = m.old_id",
+    "UPDATE adr_key SET user_id = m.new_id FROM unnest(?::text[], ?::text[]) AS m(old_id, new_id) WHERE user_id = m.old_id",
+    "UPDATE project SET shared_by = m.new_id FROM unnest(?::text[], ?::text[]) AS m(old_id, new_id) WHERE shared_by = m.old_id",
+    "UPDATE project SET user_id = m.new_id FROM unnest(?::text[], ?::text[]) AS m(old_id, new_id) WHERE user_id = m.old_id",
+    "DELETE FROM users USING unnest(?::text[], ?::text[]) AS m(old_id, new_id) WHERE id = m.old_id"
+]
+
+def fix = new DataFix("lowercase_user_ids")
+def query = "SELECT id FROM users WHERE id ~ '[A-Z]'"
+fix.run(query, { it.id.toLowerCase() }) { Sql sql, List rows ->
+    def newIds = rows.collect { it.id.toLowerCase() }.unique()
+    def existing = sql.rows("SELECT id FROM users WHERE id = ANY(?::text[])",
+            [sql.connection.createArrayOf("text", newIds as Object[])])
+            .collect { it.id } as Set
+    def oldIds = []
+    rows.each { row ->
+        def newId = row.id.toLowerCase()
+        if (existing.contains(newId)) {
+            println "Not migrating " + row.id + " as account already exists for id " + newId
+        } else {
+            existing << newId
+            oldIds << row.id
         }
-        def new_id = this.new_id
-        def old_id = this.old_id
-        def updateSql = """
-        INSERT into users (id, username) VALUES ('${new_id}', '${new_id}');
-        UPDATE user_session set user_id = '${new_id}' where user_id = '${old_id}';
-        UPDATE adr_key set user_id = '${new_id}' where user_id = '${old_id}';
-        UPDATE project set shared_by = '${new_id}' where shared_by = '${old_id}';
-        UPDATE project set user_id = '${new_id}' where user_id = '${old_id}';
-
-        DELETE from users where id = '${old_id}';
-        """
-        def sql = updateSql.toString()
-        con.execute sql
-        println "Migrated " + this.old_id + " to " + this.new_id
-        return
-    }
-}
-
-def dbUrl      = "jdbc:postgresql://hint-db/hint"
-def dbUser     = "hintuser"
-def dbPassword = "changeme"
-def dbDriver   = "org.postgresql.Driver"
-def con = Sql.newInstance(dbUrl, dbUser, dbPassword, dbDriver)
-
-def users = []
-try {
-    con.eachRow("SELECT id FROM users WHERE id ~ '[A-Z]';") { row ->
-        users << new Profile(con, row.id)
     }
-
-    con.withTransaction {
-        users.each { user ->
-            user.migrate()
-        }
+    if (!oldIds) {
+        return
     }
-} finally {
-    con.close()
+    def params = [sql.connection.createArrayOf("text", oldIds as Object[]),
+                  sql.connection.createArrayOf("text", oldIds*.toLowerCase() as Object[])]
+    migrateSql.each { sql.executeUpdate(it, params) }
+    oldIds.each { println "Migrated " + it + " to " + it.toLowerCase() }
 }
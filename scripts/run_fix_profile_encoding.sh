@@ -1,4 +1,5 @@
 #!/usr/bin/env bash
 set -ex
 
-docker run --rm -v "$PWD":/home/groovy/scripts --network=hint_nw -w /home/groovy/scripts groovy:4.0.4-jdk11-alpine groovy fix_profile_encoding.groovy
+cd "$(dirname "$0")/.."
+./hint data-fix "$@" fix_profile_encoding
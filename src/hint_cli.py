@@ -5,7 +5,12 @@ Usage:
   ./hint stop  [--volumes] [--network] [--kill] [--force]
   ./hint destroy
   ./hint status
-  ./hint upgrade [--hintr-branch=<branch>] [--hint-branch=<branch>] (hintr|all)
+  ./hint upgrade [--hintr-branch=<branch>] [--hint-branch=<branch>] hintr
+  ./hint upgrade [--hintr-branch=<branch>] [--hint-branch=<branch>]
+                 [--blue-green] all
+  ./hint scale <pool> <count>
+  ./hint history [--limit=<n>] [--threshold=<pct>]
+  ./hint data-fix [--batch-size=<n>] [--parallel=<n>] [--reset] <script>
   ./hint user [--pull] add <email> [<password>]
   ./hint user [--pull] remove <email>
   ./hint user [--pull] exists <email>
@@ -18,23 +23,42 @@ Options:
                             but possible db corruption)
   --hint-branch=<branch>    The hint branch to deploy
   --hintr-branch=<branch>   The hintr branch to deploy
+  --blue-green              Upgrade hint and hintr only, switching the proxy
+                            to a new hint container once it is responsive
+  --limit=<n>               Number of deploys to show [default: 20]
+  --threshold=<pct>         Flag deploys slower than the rolling median
+                            by more than this percentage [default: 25]
+  --batch-size=<n>          Rows fixed per transaction [default: 500]
+  --parallel=<n>            Number of batches fixed at once [default: 4]
+  --reset                   Ignore any checkpoint from a previous run
 """
 
 import docopt
+import hashlib
+import json
 import os
 import os.path
 import pickle
+import re
 import time
 import timeago
 
+import src.hint_deploy
+
 from src.hint_deploy import \
     HintConfig, \
     hint_constellation, \
     hint_start, \
     hint_upgrade_hintr, \
     hint_upgrade_all, \
+    hint_scale, \
+    hint_status, \
     hint_user, \
-    hint_stop
+    hint_data_fix, \
+    hint_stop, \
+    redis_resolve_password
+from src.hint_docker import docker_session
+from src.hint_history import DeployRecord, history_append, history_report
 
 
 # Returned options are passed to constellation and override
@@ -80,6 +104,23 @@ def parse(argv=None):
             action = "upgrade_hintr"
         else:
             action = "upgrade_all"
+            args = {"blue_green": dat["--blue-green"]}
+    elif dat["scale"]:
+        action = "scale"
+        args = {"name": dat["<pool>"], "count": int(dat["<count>"])}
+        options = {}
+    elif dat["history"]:
+        action = "history"
+        args = {"limit": int(dat["--limit"]),
+                "threshold": float(dat["--threshold"])}
+        options = {}
+    elif dat["data-fix"]:
+        action = "data_fix"
+        args = {"script": dat["<script>"],
+                "batch_size": int(dat["--batch-size"]),
+                "parallel": int(dat["--parallel"]),
+                "reset": dat["--reset"]}
+        options = {}
     elif dat["user"]:
         action = "user"
         if dat["add"]:
@@ -100,10 +141,11 @@ def path_last_deploy(path):
     return path + "/.last_deploy"
 
 
-def save_config(path, config_name, cfg):
+# Only which configuration was deployed is kept; the configuration
+# itself is rebuilt (or loaded from the cache) by each command.
+def save_config(path, config_name):
     dat = {"config_name": config_name,
-           "time": time.time(),
-           "data": cfg}
+           "time": time.time()}
     with open(path_last_deploy(path), "wb") as f:
         pickle.dump(dat, f)
 
@@ -118,15 +160,108 @@ def load_config(path, config_name=None, options=None):
     if os.path.exists(path_last_deploy(path)):
         dat = read_config(path)
         when = timeago.format(dat["time"])
-        cfg = HintConfig(path, dat["config_name"], options=options)
+        cfg = build_config(path, dat["config_name"], options)
         config_name = dat["config_name"]
         print("[Loaded configuration '{}' ({})]".format(
             config_name or "<base>", when))
     else:
-        cfg = HintConfig(path, config_name, options=options)
+        cfg = build_config(path, config_name, options)
     return config_name, cfg
 
 
+CONFIG_CACHE_SIZE = 20
+
+
+def path_config_cache(path):
+    return path + "/.config_cache"
+
+
+# Compiled configurations are cached before any vault secrets are
+# resolved, so the cache only ever holds the 'VAULT:' references.
+# Values taken from environment variables (such as the vault
+# credentials) are written as references to the variable too, and
+# read back from the environment when the entry is loaded.
+def build_config(path, config_name=None, options=None):
+    cache = path_config_cache(path)
+    sources = config_sources(path, config_name)
+    env = config_env(sources)
+    filename = os.path.join(cache, config_cache_key(path, config_name,
+                                                    options, sources))
+    if os.path.exists(filename):
+        try:
+            with open(filename, "rb") as f:
+                cfg = ConfigUnpickler(f).load()
+            os.utime(filename)
+            return cfg
+        except Exception:
+            pass
+    cfg = HintConfig(path, config_name, options=options)
+    os.makedirs(cache, exist_ok=True)
+    tmp = filename + ".tmp"
+    with open(tmp, "wb") as f:
+        ConfigPickler(f, env).dump(cfg)
+    os.replace(tmp, filename)
+    config_cache_prune(cache)
+    return cfg
+
+
+class ConfigPickler(pickle.Pickler):
+    def __init__(self, f, env):
+        super().__init__(f)
+        self.env = {v: k for k, v in env.items() if v}
+
+    def persistent_id(self, obj):
+        if isinstance(obj, str) and obj in self.env:
+            return self.env[obj]
+        return None
+
+
+class ConfigUnpickler(pickle.Unpickler):
+    def persistent_load(self, pid):
+        return os.environ[pid]
+
+
+def config_sources(path, config_name):
+    files = ["hint.yml"]
+    if config_name:
+        files.append("{}.yml".format(config_name))
+    ret = {}
+    for filename in files:
+        with open(os.path.join(path, filename), "rb") as f:
+            ret[filename] = f.read()
+    return ret
+
+
+def config_env(sources):
+    names = set()
+    for contents in sources.values():
+        names.update(re.findall(rb"\$([0-9A-Z_]+)", contents))
+    return {x: os.environ.get(x) for x in sorted(x.decode() for x in names)}
+
+
+# The key covers everything that HintConfig reads: the yml files,
+# the values of environment variables they refer to, the overrides
+# from the command line and the code that interprets them.
+def config_cache_key(path, config_name, options, sources=None):
+    h = hashlib.sha256()
+    sources = sources or config_sources(path, config_name)
+    for filename, contents in sources.items():
+        h.update(filename.encode() + b"\0" + contents + b"\0")
+    for var, value in config_env(sources).items():
+        h.update(var.encode() + b"=" + str(value).encode() + b"\0")
+    h.update(json.dumps([config_name, options], sort_keys=True).encode())
+    with open(src.hint_deploy.__file__, "rb") as f:
+        h.update(f.read())
+    return h.hexdigest()
+
+
+def config_cache_prune(cache):
+    entries = [os.path.join(cache, x) for x in os.listdir(cache)]
+    entries.sort(key=os.path.getmtime, reverse=True)
+    for x in entries[CONFIG_CACHE_SIZE:]:
+        os.unlink(x)
+
+
 def remove_config(path):
     p = path_last_deploy(path)
     if os.path.exists(p):
@@ -155,25 +290,46 @@ def prompt_yes_no(get_input=input):
 
 
 def main(argv=None):
-    path, config_name, action, args, options = parse(argv)
-    config_name, cfg = load_config(path, config_name, options)
-    obj = hint_constellation(cfg)
-    if action == "user":
-        hint_user(cfg, **args)
-    elif action == "upgrade_hintr":
-        hint_upgrade_hintr(obj)
-    elif action == "upgrade_all":
-        verify_data_loss(action, args, cfg)
-        hint_upgrade_all(obj, cfg.db_tag)
-    elif action == "start":
-        verify_data_loss(action, args, cfg)
-        hint_start(obj, cfg, args)
-        save_config(path, config_name, cfg)
-    elif action == "stop":
-        verify_data_loss(action, args, cfg)
-        hint_stop(obj, args)
-        if args["remove_volumes"]:
-            remove_config(path)
-    else:
-        verify_data_loss(action, args, cfg)
-        obj.__getattribute__(action)(**args)
+    with docker_session():
+        path, config_name, action, args, options = parse(argv)
+        if action == "history":
+            history_report(path, **args)
+            return
+        config_name, cfg = load_config(path, config_name, options)
+        if action in ["start", "upgrade_hintr", "upgrade_all", "scale"]:
+            redis_resolve_password(cfg)
+        obj = hint_constellation(cfg)
+        if action != "user":
+            verify_data_loss(action, args, cfg)
+        record = None
+        if action in ["start", "stop", "upgrade_hintr", "upgrade_all"]:
+            record = DeployRecord(action, config_name, cfg)
+        try:
+            if action == "user":
+                hint_user(cfg, **args)
+            elif action == "upgrade_hintr":
+                hint_upgrade_hintr(obj, record=record)
+            elif action == "upgrade_all":
+                hint_upgrade_all(obj, cfg.db_tag, **args, record=record)
+            elif action == "scale":
+                hint_scale(obj, **args)
+            elif action == "status":
+                hint_status(obj, cfg)
+            elif action == "data_fix":
+                hint_data_fix(cfg, **args)
+            elif action == "start":
+                hint_start(obj, cfg, args, record=record)
+                save_config(path, config_name)
+            elif action == "stop":
+                hint_stop(obj, args, record=record)
+                if args["remove_volumes"]:
+                    remove_config(path)
+            else:
+                obj.__getattribute__(action)(**args)
+        except Exception as e:
+            if record:
+                record.fail(e)
+            raise
+        finally:
+            if record:
+                history_append(path, record)
@@ -1,11 +1,60 @@
+import concurrent.futures
 import docker
 import math
+import os.path
 import requests
 import time
+import urllib.parse
 
 import constellation
 import constellation.config as config
 import constellation.docker_util as docker_util
+import constellation.vault as vault
+from constellation.util import rand_str
+
+from src.hint_docker import docker_instrument
+from src.hint_history import phase
+from src.hint_upgrade_gate import upgrade_gated
+
+DB_USER = "hintuser"
+DB_PASSWORD = "changeme"
+DB_URL_DIRECT = "jdbc:postgresql://db/hint"
+# Where the user cli finds the deployed configuration to copy from
+HINT_CONFIG_DEPLOYED = "/run/hint-config"
+DB_SCHEMA_STATE_SQL = ("SELECT count(*) || ':' || "
+                       "coalesce(max(installed_rank), 0) "
+                       "FROM flyway_schema_history WHERE success")
+DB_SCHEMA_FINGERPRINT_SQL = ("SELECT obj_description("
+                             "'flyway_schema_history'::regclass, 'pg_class')")
+JVM_GC = {"G1": "-XX:+UseG1GC",
+          "Parallel": "-XX:+UseParallelGC",
+          "Serial": "-XX:+UseSerialGC",
+          "ZGC": "-XX:+UseZGC",
+          "Shenandoah": "-XX:+UseShenandoahGC"}
+
+# Names of the containers other than the worker pools; blue/green hint
+# candidates are named 'hint-<random>'
+CONTAINER_NAMES = ["db", "pgbouncer", "redis", "redis-cache", "hintr-api",
+                   "hintr", "hint", "proxy"]
+
+# Containers are stopped in tiers, each after the one before it has
+# stopped; anything not named here is stopped with hintr
+STOP_TIERS = {"front": ["proxy", "hint"],
+              "hintr": None,
+              "data": ["db", "redis", "redis-cache"]}
+STOP_TIMEOUTS = {"front": 10, "hintr": 10, "data": 60}
+
+DATA_FIX_IMAGE = "groovy:4.0.4-jdk11-alpine"
+DATA_FIX_SCRIPTS = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts")
+
+PROXY_PERFORMANCE_CONF = "/etc/nginx/conf.d/performance.conf"
+PROXY_PERFORMANCE_SERVER_CONF = "/etc/nginx/hint-performance.conf"
+PROXY_COMPRESS_TYPES = ["text/plain", "text/css", "text/javascript",
+                        "application/javascript", "application/json",
+                        "image/svg+xml"]
+PROXY_STATIC_EXTENSIONS = ["js", "css", "png", "svg", "ico", "woff",
+                           "woff2"]
 
 
 class HintConfig:
@@ -13,26 +62,101 @@ class HintConfig:
         dat = config.read_yaml("{}/hint.yml".format(path))
         dat = config.config_build(path, dat, config_name, options=options)
         self.dat = dat
+        self.path = path
         self.network = config.config_string(dat, ["docker", "network"])
         self.prefix = config.config_string(dat, ["docker", "prefix"])
         default_tag = config.config_string(dat, ["docker", "default_tag"],
                                            True, "master")
         self.redis_tag = config.config_string(dat, ["redis", "tag"],
                                               True, default_tag)
+        self.redis_port = config.config_integer(dat, ["redis", "port"], True)
+        self.redis_host = config.config_string(dat, ["redis", "host"], True)
+        self.redis_bind = config.config_string(dat, ["redis", "bind"], True)
+        self.redis_password = config.config_string(
+            dat, ["redis", "password"], True)
+        persistence = ["redis", "persistence"]
+        self.redis_appendfsync = config.config_enum(
+            dat, persistence + ["appendfsync"], ["always", "everysec", "no"],
+            True, "everysec")
+        self.redis_aof_use_rdb_preamble = config.config_boolean(
+            dat, persistence + ["aof_use_rdb_preamble"], True, True)
+        self.redis_maxmemory = config.config_string(
+            dat, persistence + ["maxmemory"], True)
+        self.redis_maxmemory_policy = config.config_string(
+            dat, persistence + ["maxmemory_policy"], True, "noeviction")
+        self.redis_load_timeout = config.config_integer(
+            dat, persistence + ["load_timeout"], True, 20)
+        self.redis_compact_timeout = config.config_integer(
+            dat, persistence + ["compact_timeout"], True, 300)
+        cache = ["redis", "cache"]
+        self.redis_cache_enabled = config.config_boolean(
+            dat, cache + ["enabled"], True, False)
+        self.redis_cache_maxmemory = config.config_string(
+            dat, cache + ["maxmemory"], True, "1gb")
+        self.redis_cache_maxmemory_policy = config.config_string(
+            dat, cache + ["maxmemory_policy"], True, "allkeys-lru")
+        self.redis_cache_port = config.config_integer(
+            dat, cache + ["port"], True)
         self.db_tag = config.config_string(dat, ["db", "tag"],
                                            True, default_tag)
+        self.pgbouncer_enabled = config.config_boolean(
+            dat, ["pgbouncer", "enabled"], True, False)
+        self.pgbouncer_tag = config.config_string(
+            dat, ["pgbouncer", "tag"], True, "v1.23.1-p2")
+        self.pgbouncer_pool_mode = config.config_enum(
+            dat, ["pgbouncer", "pool_mode"],
+            ["session", "transaction", "statement"], True, "transaction")
+        self.pgbouncer_pool_size = config.config_integer(
+            dat, ["pgbouncer", "pool_size"], True, 20)
+        self.pgbouncer_max_client_conn = config.config_integer(
+            dat, ["pgbouncer", "max_client_conn"], True, 200)
+        self.pgbouncer_auth_type = config.config_string(
+            dat, ["pgbouncer", "auth_type"], True, "md5")
         self.hint_tag = config.config_string(dat, ["hint", "tag"],
                                              True, default_tag)
         self.hint_expose = config.config_boolean(dat, ["hint", "expose"],
                                                  True, False)
+        self.hint_ref = constellation.ImageReference("mrcide", "hint",
+                                                     self.hint_tag)
         self.hintr_tag = config.config_string(dat, ["hintr", "tag"],
                                               True, default_tag)
         self.volumes = config.config_dict(dat, ["volumes"])
-        self.hintr_workers = config.config_integer(dat, ["hintr", "workers"])
-        self.hintr_calibrate_workers = config.config_integer(
-            dat, ["hintr", "calibrate-workers"])
+        self.hintr_worker_pools = hintr_worker_pools(dat, self.hintr_tag)
+        endpoints = config.config_dict(dat, ["docker", "endpoints"], True, {})
+        self.docker_endpoints = {x: DockerEndpoint(dat, x)
+                                 for x in endpoints.keys()}
+        # Without driver options a remote worker would get a local
+        # volume, and write results that hint never sees
+        hintr_volumes = config.config_list(dat, ["hintr", "volumes"])
+        for endpoint in self.docker_endpoints.values():
+            missing = [x for x in hintr_volumes if x not in endpoint.volumes]
+            if missing:
+                raise ValueError(
+                    "Endpoint '{}' needs volume options for {}".format(
+                        endpoint.name, ", ".join(missing)))
+        for pool in self.hintr_worker_pools:
+            for x in pool.placement.keys():
+                if x not in self.docker_endpoints:
+                    raise ValueError(
+                        "Pool '{}' is placed on unknown endpoint '{}'".format(
+                            pool.name, x))
+            if pool.placement and not (self.redis_port and self.redis_host):
+                raise ValueError("Workers on other docker endpoints need "
+                                 "redis:port and redis:host to be set")
+            if pool.placement and not (self.redis_bind and
+                                       self.redis_password):
+                raise ValueError("Workers on other docker endpoints need "
+                                 "redis:bind and redis:password to be set")
+            if pool.placement and self.redis_cache_enabled and \
+               not self.redis_cache_port:
+                raise ValueError("Workers on other docker endpoints need "
+                                 "redis:cache:port to be set")
         self.hintr_use_mock_model = config.config_boolean(
             dat, ["hintr", "use_mock_model"], True, False)
+        self.hintr_queue_id = config.config_string(
+            dat, ["hintr", "drain", "queue_id"], True, "hintr")
+        self.hintr_drain_timeout = config.config_integer(
+            dat, ["hintr", "drain", "timeout"], True, 600)
         self.hintr_port = config.config_integer(
             dat, ["hintr", "port"]
         )
@@ -46,12 +170,14 @@ class HintConfig:
         )
         self.hintr_ref = constellation.ImageReference(
             "mrcide", "hintr", self.hintr_tag)
-        self.hintr_worker_ref = constellation.ImageReference(
-            "mrcide", "hintr-worker", self.hintr_tag)
 
         self.hint_email_password = config.config_string(
             dat, ["hint", "email", "password"], True, "")
 
+        self.hint_jvm_options = hint_jvm_options(dat, ["hint", "jvm"])
+        # Measured by hint_configure each time hint is started
+        self.hint_responsive_seconds = None
+
         self.hint_issue_report_url = config.config_string(
             dat, ["hint", "issue_report_url"], True, "")
 
@@ -93,6 +219,25 @@ class HintConfig:
             dat, ["proxy", "ssl", "certificate"], True)
         self.proxy_ssl_key = config.config_string(
             dat, ["proxy", "ssl", "key"], True)
+        self.proxy_performance = config.config_dict(
+            dat, ["proxy", "performance"], True) is not None
+        self.proxy_gzip_level = config.config_integer(
+            dat, ["proxy", "performance", "gzip_level"], True, 5)
+        self.proxy_brotli_level = config.config_integer(
+            dat, ["proxy", "performance", "brotli_level"], True)
+        # Left unset, these keep the values from the proxy image
+        self.proxy_http2 = config.config_boolean(
+            dat, ["proxy", "performance", "http2"], True)
+        self.proxy_static_max_age = config.config_integer(
+            dat, ["proxy", "performance", "static_max_age"], True, 0)
+        self.proxy_ssl_session_cache = config.config_string(
+            dat, ["proxy", "performance", "ssl_session_cache"], True)
+        self.proxy_ssl_session_timeout = config.config_string(
+            dat, ["proxy", "performance", "ssl_session_timeout"], True)
+        self.proxy_keepalive_timeout = config.config_integer(
+            dat, ["proxy", "performance", "keepalive_timeout"], True)
+        self.proxy_keepalive_requests = config.config_integer(
+            dat, ["proxy", "performance", "keepalive_requests"], True)
         self.vault = config.config_vault(dat, ["vault"])
         self.add_test_user = config.config_boolean(
             dat, ["users", "add_test_user"], True, False)
@@ -100,22 +245,335 @@ class HintConfig:
         self.protect_data = config.config_boolean(
             dat, ["deploy", "protect_data"], True, False)
 
+        self.stop_timeouts = {
+            tier: config.config_integer(
+                dat, ["deploy", "stop_timeouts", tier], True, default)
+            for tier, default in STOP_TIMEOUTS.items()}
+
+        gate = ["deploy", "upgrade_gate"]
+        self.upgrade_gate = config.config_dict(dat, gate, True) is not None
+        self.upgrade_gate_requests = config.config_integer(
+            dat, gate + ["requests"], True, 20)
+        self.upgrade_gate_targets = config.config_dict(
+            dat, gate + ["targets"], True,
+            {"hint": "http://localhost:8080",
+             "hintr": "http://localhost:{}".format(self.hintr_port)})
+        self.upgrade_gate_max_p95_ratio = config_number(
+            dat, gate + ["max_p95_ratio"], True, 1.5)
+        self.upgrade_gate_slack_ms = config_number(
+            dat, gate + ["slack_ms"], True, 100)
+        self.upgrade_gate_max_error_rate = config_number(
+            dat, gate + ["max_error_rate"], True, 0.05)
+
     def get_constellation_mounts(self, mount_ref):
+        return self.get_volume_mounts(mount_ref) + \
+            scratch_mounts(self.dat, [mount_ref, "scratch"], [])
+
+    def get_volume_mounts(self, mount_ref):
         return [
             constellation.ConstellationMount(key, self.volumes[key]["path"])
             for key in config.config_list(self.dat, [mount_ref, "volumes"])
         ]
 
 
+# Scratch space is for intermediate files that do not need to
+# survive the container, either in memory (tmpfs, capped at 'size')
+# or in a directory on the host's local disk (bind, from 'source').
+class ScratchMount:
+    def __init__(self, dat, path):
+        self.path = config.config_string(dat, path + ["path"])
+        self.type = config.config_string(dat, path + ["type"], True, "tmpfs")
+        if self.type == "tmpfs":
+            self.size = config.config_string(dat, path + ["size"], True)
+        elif self.type == "bind":
+            self.source = config.config_string(dat, path + ["source"])
+        else:
+            raise ValueError("Unknown scratch type '{}' for {}".format(
+                self.type, ":".join(path)))
+
+    def to_mount(self, volumes):
+        if self.type == "tmpfs":
+            return docker.types.Mount(self.path, None, type="tmpfs",
+                                      tmpfs_size=self.size)
+        return docker.types.Mount(self.path, self.source, type="bind")
+
+
+def scratch_mounts(dat, path, default=None):
+    scratch = config.config_dict(dat, path, True)
+    if scratch is None:
+        return default
+    return [ScratchMount(dat, path + [x]) for x in scratch.keys()]
+
+
+# R puts its session temporary directory under TMPDIR, so pointing
+# that at the first scratch mount keeps hintr's intermediate files
+# off the persistent volumes.
+def scratch_environment(env, mounts):
+    scratch = [x for x in mounts if isinstance(x, ScratchMount)]
+    if not scratch:
+        return env
+    return dict(env, TMPDIR=scratch[0].path)
+
+
+class HintrWorkerPool:
+    def __init__(self, dat, name, default_tag):
+        path = ["hintr", "worker_pools", name]
+        self.name = name
+        self.workers = config.config_integer(dat, path + ["workers"])
+        self.args = config.config_list(dat, path + ["args"], True, [])
+        tag = config.config_string(dat, path + ["tag"], True, default_tag)
+        self.ref = constellation.ImageReference("mrcide", "hintr-worker", tag)
+        self.memory = config.config_string(
+            dat, path + ["resources", "memory"], True)
+        self.cpus = config_number(dat, path + ["resources", "cpus"], True)
+        self.scratch = scratch_mounts(dat, path + ["scratch"])
+        self.placement = config.config_dict(dat, path + ["placement"],
+                                            True, {})
+        for x in self.placement.keys():
+            config.config_integer(dat, path + ["placement", x])
+
+    def configure(self, container, cfg):
+        if self.memory or self.cpus:
+            print("[{}] Applying resource limits to {}".format(
+                self.name, container.name))
+            container_set_resources(container, self.memory, self.cpus)
+
+
+# Older configurations declare exactly two pools through
+# 'workers' and 'calibrate-workers'
+def hintr_worker_pools(dat, default_tag):
+    if config.config_dict(dat, ["hintr", "worker_pools"], True) is None:
+        workers = config.config_integer(dat, ["hintr", "workers"])
+        calibrate = config.config_integer(dat, ["hintr", "calibrate-workers"])
+        pools = {"worker": {"workers": workers},
+                 "calibrate-worker": {"workers": calibrate,
+                                      "args": ["--calibrate-only"]}}
+        dat = {"hintr": {"worker_pools": pools}}
+    names = list(config.config_dict(dat, ["hintr", "worker_pools"]).keys())
+    for i, x in enumerate(names):
+        others = CONTAINER_NAMES + names[:i] + names[i + 1:]
+        clash = [y for y in others if name_clash(x, y)]
+        if clash:
+            raise ValueError("Worker pool name '{}' clashes with '{}'".format(
+                x, clash[0]))
+    return [HintrWorkerPool(dat, x, default_tag) for x in names]
+
+
+# Service replicas are found by the prefix '<prefix>-<name>-', so one
+# name must not be the other followed by a dash
+def name_clash(a, b):
+    return a == b or a.startswith(b + "-") or b.startswith(a + "-")
+
+
+# Another docker daemon that runs some of the workers; these reach
+# redis on its published port and the shared volumes through the
+# docker volume options given for the endpoint (e.g., an nfs mount).
+class DockerEndpoint:
+    def __init__(self, dat, name):
+        path = ["docker", "endpoints", name]
+        self.name = name
+        self.base_url = config.config_string(dat, path + ["base_url"])
+        self.tls = config.config_boolean(dat, path + ["tls"], True, False)
+        self.volumes = config.config_dict(dat, path + ["volumes"], True, {})
+
+    def client(self):
+        return docker_instrument(docker.DockerClient(
+            base_url=self.base_url, tls=self.tls,
+            use_ssh_client=self.base_url.startswith("ssh://")))
+
+
+# The replicas of one worker pool on another endpoint. Constellation
+# only talks to the local daemon, so these are managed alongside it
+# rather than as part of it.
+class RemoteWorkers:
+    def __init__(self, cfg, pool, endpoint, count, client=None):
+        self.cfg = cfg
+        self.pool = pool
+        self.endpoint = endpoint
+        self.count = count
+        self.name = "{}-{}-{}".format(cfg.prefix, pool.name, endpoint.name)
+        self._client = client
+
+    @property
+    def client(self):
+        if not self._client:
+            self._client = self.endpoint.client()
+        return self._client
+
+    def containers(self):
+        return [x for x in self.client.containers.list(
+            all=True, filters={"name": self.name + "-"})
+                if x.name.startswith(self.name + "-")]
+
+    def start(self, pull):
+        print("[{}] Starting {} workers on {}".format(
+            self.pool.name, self.count, self.endpoint.name))
+        ref = str(self.pool.ref)
+        try:
+            self.client.images.get(ref)
+            exists = True
+        except docker.errors.ImageNotFound:
+            exists = False
+        if pull or not exists:
+            print("    - pulling {}".format(ref))
+            self.client.images.pull(ref)
+        if not self.client.networks.list(names=[self.cfg.network]):
+            self.client.networks.create(self.cfg.network)
+        volumes = self.volumes()
+        mounts = [x.to_mount(volumes) for x in worker_mounts(self.cfg,
+                                                             self.pool)]
+        env = {"REDIS_URL": redis_url(self.cfg.redis_host,
+                                      self.cfg.redis_port,
+                                      self.cfg.redis_password)}
+        if self.cfg.redis_cache_enabled:
+            env["REDIS_CACHE_URL"] = redis_url(self.cfg.redis_host,
+                                               self.cfg.redis_cache_port,
+                                               self.cfg.redis_password)
+        if self.cfg.hintr_use_mock_model:
+            env["USE_MOCK_MODEL"] = "true"
+        env = scratch_environment(env, worker_mounts(self.cfg, self.pool))
+        # Names are random, as for constellation services, so that new
+        # workers can start while old ones are still draining
+        for i in range(self.count):
+            container = self.client.containers.run(
+                ref, self.pool.args, name=rand_str(8, self.name + "-"),
+                network=self.cfg.network, mounts=mounts, environment=env,
+                detach=True)
+            self.pool.configure(container, self.cfg)
+
+    def volumes(self):
+        ret = {}
+        existing = [x.name for x in self.client.volumes.list()]
+        for key in config.config_list(self.cfg.dat, ["hintr", "volumes"]):
+            name = self.cfg.volumes[key]["name"]
+            if name not in existing:
+                self.client.volumes.create(
+                    name, driver_opts=self.endpoint.volumes[key])
+            ret[key] = name
+        return ret
+
+    def stop(self, kill=False):
+        for container in self.containers():
+            if container.status == "running":
+                print("Stopping {} on {}".format(container.name,
+                                                 self.endpoint.name))
+                if kill:
+                    container.kill()
+                else:
+                    container.exec_run(["hintr_stop"])
+                    container.stop()
+            container.remove(force=True)
+
+    def status(self):
+        try:
+            containers = {x.name: x.status for x in self.containers()}
+        except docker.errors.DockerException as e:
+            print("    {}: unreachable ({})".format(self.endpoint.name, e))
+            return
+        for name in sorted(containers.keys()):
+            print("    {} ({}): {}".format(
+                name, self.endpoint.name, containers[name]))
+        if len(containers) < self.count:
+            print("    {} ({}): {} missing".format(
+                self.name, self.endpoint.name, self.count - len(containers)))
+
+
+def hint_remote_workers(cfg, clients=None):
+    clients = clients or {}
+    return [RemoteWorkers(cfg, pool, cfg.docker_endpoints[name], count,
+                          clients.get(name))
+            for pool in cfg.hintr_worker_pools
+            for name, count in pool.placement.items()]
+
+
+# The JVM picks these up from JAVA_TOOL_OPTIONS, so they apply
+# whatever command the image uses to start hint
+def hint_jvm_options(dat, path):
+    ret = []
+    heap_min = config.config_string(dat, path + ["heap_min"], True)
+    if heap_min:
+        ret.append("-Xms" + heap_min)
+    heap_max = config.config_string(dat, path + ["heap_max"], True)
+    if heap_max:
+        ret.append("-Xmx" + heap_max)
+    ram = config_number(dat, path + ["max_ram_percentage"], True)
+    if ram:
+        ret.append("-XX:MaxRAMPercentage={}".format(ram))
+    gc = config.config_string(dat, path + ["gc"], True)
+    if gc:
+        ret.append(JVM_GC[config.config_enum(dat, path + ["gc"],
+                                             list(JVM_GC.keys()))])
+    pause = config.config_integer(dat, path + ["max_gc_pause_ms"], True)
+    if pause:
+        ret.append("-XX:MaxGCPauseMillis={}".format(pause))
+    archive = config.config_string(dat, path + ["cds_archive"], True)
+    if archive:
+        ret.append("-XX:SharedArchiveFile=" + archive)
+        # Needs JDK 19 or later; the archive is written on the first
+        # exit and used from then on
+        if config.config_boolean(dat, path + ["cds_auto_create"], True,
+                                 False):
+            ret.append("-XX:+AutoCreateSharedArchive")
+    ret += config.config_list(dat, path + ["options"], True, [])
+    return ret
+
+
+def config_number(data, path, is_optional=False, default=None):
+    parent = config.config_dict(data, path[:-1], is_optional)
+    value = parent.get(path[-1]) if parent else None
+    if value is None:
+        if is_optional:
+            return default
+        raise KeyError(":".join(path))
+    if type(value) not in [int, float]:
+        raise ValueError("Expected number for {}".format(":".join(path)))
+    return value
+
+
+def container_set_resources(container, memory=None, cpus=None):
+    args = {}
+    if memory:
+        # Swap has to be updated along with memory, and setting it
+        # to the same value disables swap for the container.
+        args["mem_limit"] = memory
+        args["memswap_limit"] = memory
+    if cpus:
+        args["cpu_period"] = 100000
+        args["cpu_quota"] = int(cpus * 100000)
+    container.update(**args)
+
+
 def hint_constellation(cfg):
     # Redis
     redis_ref = constellation.ImageReference("library", "redis",
                                              cfg.redis_tag)
     redis_mounts = cfg.get_constellation_mounts("redis")
     redis_args = ["--appendonly", "yes"]
+    # redis-cli reads the password from REDISCLI_AUTH, so the scripts
+    # and commands run inside the container need no changes
+    redis_auth_args = []
+    redis_env = None
+    if cfg.redis_password:
+        redis_auth_args = ["--requirepass", cfg.redis_password]
+        redis_env = {"REDISCLI_AUTH": cfg.redis_password}
     redis = constellation.ConstellationContainer(
-        "redis", redis_ref, mounts=redis_mounts, args=redis_args,
-        configure=redis_configure)
+        "redis", redis_ref, mounts=redis_mounts,
+        args=redis_args + redis_auth_args, environment=redis_env,
+        ports=redis_ports(cfg, cfg.redis_port), configure=redis_configure)
+
+    # Optional second redis for cached data; nothing is written to disk
+    # and keys are evicted once it is full, so the durable instance
+    # above only has to persist the job queue
+    if cfg.redis_cache_enabled:
+        redis_cache_args = ["--appendonly", "no", "--save", "",
+                            "--maxmemory", cfg.redis_cache_maxmemory,
+                            "--maxmemory-policy",
+                            cfg.redis_cache_maxmemory_policy]
+        redis_cache = constellation.ConstellationContainer(
+            "redis-cache", redis_ref,
+            args=redis_cache_args + redis_auth_args, environment=redis_env,
+            ports=redis_ports(cfg, cfg.redis_cache_port),
+            configure=redis_cache_configure)
 
     # The db
     db_ref = constellation.ImageReference(
@@ -124,6 +582,23 @@ def hint_constellation(cfg):
     db = constellation.ConstellationContainer(
         "db", db_ref, mounts=db_mounts, configure=db_configure)
 
+    # Connection pooler between hint and the db (migrations and admin
+    # scripts still go direct to the db)
+    if cfg.pgbouncer_enabled:
+        pgbouncer_ref = constellation.ImageReference(
+            "edoburu", "pgbouncer", cfg.pgbouncer_tag)
+        pgbouncer_env = {"DB_HOST": db.name,
+                         "DB_NAME": "hint",
+                         "DB_USER": DB_USER,
+                         "DB_PASSWORD": DB_PASSWORD,
+                         "AUTH_TYPE": cfg.pgbouncer_auth_type,
+                         "POOL_MODE": cfg.pgbouncer_pool_mode,
+                         "DEFAULT_POOL_SIZE": str(cfg.pgbouncer_pool_size),
+                         "MAX_CLIENT_CONN": str(cfg.pgbouncer_max_client_conn)}
+        pgbouncer = constellation.ConstellationContainer(
+            "pgbouncer", pgbouncer_ref, environment=pgbouncer_env,
+            configure=pgbouncer_configure)
+
     # hintr
     hintr_ref = cfg.hintr_ref
     hintr_args = ["--workers=0",
@@ -131,7 +606,11 @@ def hint_constellation(cfg):
                   "--inputs-dir=" + cfg.volumes["uploads"]["path"],
                   "--port=" + str(cfg.hintr_port)]
     hintr_mounts = cfg.get_constellation_mounts("hintr")
-    hintr_env = {"REDIS_URL": "redis://{}:6379".format(redis.name)}
+    hintr_env = {"REDIS_URL": redis_url(redis.name, 6379,
+                                        cfg.redis_password)}
+    if cfg.redis_cache_enabled:
+        hintr_env["REDIS_CACHE_URL"] = redis_url(redis_cache.name, 6379,
+                                                 cfg.redis_password)
     if cfg.hintr_use_mock_model:
         hintr_env["USE_MOCK_MODEL"] = "true"
     # See https://www.elastic.co/guide/en/beats/filebeat/current/configuration-autodiscover-hints.html # noqa
@@ -139,7 +618,9 @@ def hint_constellation(cfg):
     labels = {"co.elastic.logs/json.add_error_key": "true"}
     hintr = constellation.ConstellationService(
         "hintr-api", hintr_ref, cfg.api_instances, args=hintr_args,
-        mounts=hintr_mounts, environment=hintr_env, labels=labels)
+        mounts=hintr_mounts,
+        environment=scratch_environment(hintr_env, hintr_mounts),
+        labels=labels)
 
     # hintr load balancer
     hintr_loadbalancer_ref = cfg.hintr_loadbalancer_ref
@@ -149,13 +630,14 @@ def hint_constellation(cfg):
         labels=labels)
 
     # hint
-    hint_ref = constellation.ImageReference("mrcide", "hint",
-                                            cfg.hint_tag)
+    hint_ref = cfg.hint_ref
     hint_mounts = cfg.get_constellation_mounts("hint")
-    hint_ports = [8080] if cfg.hint_expose else None
+    hint_env = None
+    if cfg.hint_jvm_options:
+        hint_env = {"JAVA_TOOL_OPTIONS": " ".join(cfg.hint_jvm_options)}
     hint = constellation.ConstellationContainer(
-        "hint", hint_ref, mounts=hint_mounts, ports=hint_ports,
-        configure=hint_configure)
+        "hint", hint_ref, mounts=hint_mounts, ports=hint_ports(cfg),
+        environment=hint_env, configure=hint_configure)
 
     # proxy
     proxy_ref = constellation.ImageReference("mrcide", "hint-proxy", "latest")
@@ -168,20 +650,20 @@ def hint_constellation(cfg):
         "proxy", proxy_ref, ports=proxy_ports, args=proxy_args,
         configure=proxy_configure)
 
-    # calibrate worker
-    worker_ref = cfg.hintr_worker_ref
-    calibrate_worker_args = ["--calibrate-only"]
-    calibrate_worker = constellation.ConstellationService(
-        "calibrate-worker", worker_ref, cfg.hintr_calibrate_workers,
-        args=calibrate_worker_args, mounts=hintr_mounts, environment=hintr_env)
-
-    # hintr workers
-    worker = constellation.ConstellationService(
-        "worker", worker_ref, cfg.hintr_workers,
-        mounts=hintr_mounts, environment=hintr_env)
-
-    containers = [db, redis, hintr, load_balancer,
-                  hint, proxy, calibrate_worker, worker]
+    # hintr workers, one service per pool
+    workers = []
+    for pool in cfg.hintr_worker_pools:
+        mounts = worker_mounts(cfg, pool)
+        workers.append(constellation.ConstellationService(
+            pool.name, pool.ref, pool.workers, args=pool.args,
+            mounts=mounts, environment=scratch_environment(hintr_env, mounts),
+            configure=pool.configure))
+
+    containers = [db, redis, hintr, load_balancer, hint, proxy] + workers
+    if cfg.redis_cache_enabled:
+        containers.insert(2, redis_cache)
+    if cfg.pgbouncer_enabled:
+        containers.insert(1, pgbouncer)
 
     volume_obj = {k: v["name"] for (k, v) in cfg.volumes.items()}
     obj = constellation.Constellation("hint", cfg.prefix, containers,
@@ -191,58 +673,406 @@ def hint_constellation(cfg):
     return obj
 
 
-def hint_start(obj, cfg, args):
-    if (args["pull_images"]):
-        pull_migrate_image(cfg.db_tag)
-    obj.start(**args)
+# Docker publishes ports ahead of any host firewall rules, so redis is
+# only published on the address given (loopback by default), and
+# workers on other machines must also give the password.
+def redis_ports(cfg, port):
+    if not port:
+        return None
+    return [(6379, (cfg.redis_bind or "127.0.0.1", port))]
+
+
+def redis_url(host, port, password=None):
+    auth = ""
+    if password:
+        auth = ":{}@".format(urllib.parse.quote(password, safe=""))
+    return "redis://{}{}:{}".format(auth, host, port)
+
+
+# The password is used in the arguments and environment of containers,
+# which are fixed once the constellation is built, so unlike the other
+# secrets it is read from the vault before then rather than on start.
+def redis_resolve_password(cfg):
+    if cfg.redis_password and cfg.redis_password.startswith("VAULT:"):
+        cfg.redis_password = vault.resolve_secret(
+            cfg.redis_password, cfg.vault.client())[1]
+
+
+# A pool's own scratch mounts replace any set for hintr as a whole
+def worker_mounts(cfg, pool):
+    if pool.scratch is None:
+        return cfg.get_constellation_mounts("hintr")
+    return cfg.get_volume_mounts("hintr") + pool.scratch
+
+
+def hint_start(obj, cfg, args, record=None):
+    with phase(record, "pull"):
+        if (args["pull_images"]):
+            pull_migrate_image(cfg.db_tag)
+    with phase(record, "start"):
+        obj.start(**args)
 
     if (cfg):
         email = "test.user@example.com"
         pull = args["pull_images"]
         print("Adding test user '{}'".format(email))
-        hint_user(cfg, "add-user", email, pull, "password")
+        with phase(record, "users"):
+            hint_user(cfg, "add-user", email, pull, "password")
 
-    loadbalancer_register_hintr_api(obj)
+    with phase(record, "loadbalancer"):
+        loadbalancer_register_hintr_api(obj)
 
+    with phase(record, "remote"):
+        for x in hint_remote_workers(obj.data):
+            x.start(args["pull_images"])
 
-def hint_upgrade_hintr(obj):
+
+def hint_upgrade_hintr(obj, record=None):
+    upgrade_gated(obj.data, hintr_refs(obj.data),
+                  lambda: hintr_replace(obj, True, record),
+                  lambda: hintr_replace(obj, False, record),
+                  record=record)
+
+
+def hintr_refs(cfg):
+    return [str(cfg.hintr_loadbalancer_ref), str(cfg.hintr_ref)] + \
+        sorted(set(str(x.ref) for x in cfg.hintr_worker_pools))
+
+
+def hintr_replace(obj, pull, record=None):
     loadbalancer = obj.containers.find("hintr")
     hintr_api = obj.containers.find("hintr-api")
-    calibrate_worker = obj.containers.find("calibrate-worker")
-    worker = obj.containers.find("worker")
+    pools = [x.name for x in obj.data.hintr_worker_pools]
     hintr_containers = hintr_api.get(obj.prefix)
     loadbalancer_container = loadbalancer.get(obj.prefix)
+    remote = hint_remote_workers(obj.data)
 
     # Always pull the docker image - and do this *before* we start
-    # removing things to minimise downtime.
-    docker_util.image_pull(loadbalancer.name, str(
-        obj.data.hintr_loadbalancer_ref))
-    docker_util.image_pull(hintr_api.name, str(obj.data.hintr_ref))
-    docker_util.image_pull(hintr_api.name, str(obj.data.hintr_worker_ref))
-
-    for container in hintr_containers:
-        if container:
-            if container.status == "running":
-                print("Stopping {}".format(container.name))
-                container.exec_run(["hintr_stop"])
+    # removing things to minimise downtime. The only time we don't
+    # is when rolling back to images that are already present.
+    with phase(record, "pull"):
+        if pull:
+            refs = hintr_refs(obj.data)
+            docker_util.image_pull(loadbalancer.name, refs[0])
+            for ref in refs[1:]:
+                docker_util.image_pull(hintr_api.name, ref)
+
+    # The old workers are told to stop taking jobs, and the new pools
+    # are started alongside them straight away, so that hintr is only
+    # unavailable while the api and load balancer are replaced; the
+    # old workers are then left to finish the jobs they have.
+    with phase(record, "stop"):
+        drain = hintr_stop_workers(obj, remote)
+        for container in hintr_containers:
+            if container:
+                docker_util.container_remove_wait(container)
+        print("Killing {}".format(loadbalancer_container.name))
+        docker_util.container_stop(
+            loadbalancer_container, True, loadbalancer_container.name)
+        docker_util.container_remove_wait(loadbalancer_container)
+
+    with phase(record, "start"):
+        obj.start(subset=[loadbalancer.name, hintr_api.name] + pools)
+    with phase(record, "loadbalancer"):
+        loadbalancer_register_hintr_api(obj)
+    with phase(record, "remote"):
+        for x in remote:
+            x.start(pull)
+    with phase(record, "drain"):
+        if drain:
+            worker_drain(*drain, obj.data.hintr_drain_timeout)
+
+
+# rrq's record of what each worker is doing, kept in redis
+class WorkerQueue:
+    def __init__(self, redis, queue_id):
+        self.redis = redis
+        self.queue_id = queue_id
+
+    def workers(self):
+        return list(self.hash("worker:status").keys())
+
+    # Only the given workers are considered, if any, so that jobs
+    # picked up by their replacements are not waited on
+    def busy(self, workers=None):
+        status = self.hash("worker:status")
+        task = self.hash("worker:task")
+        return {k: task.get(k) for k, v in status.items()
+                if v == "BUSY" and (workers is None or k in workers)}
+
+    # rrq keeps each worker's hostname, which for workers in docker is
+    # the container's, in its serialised info
+    def hosts(self, hostnames):
+        ret = {}
+        key = "{}:worker:info".format(self.queue_id)
+        for worker_id in self.workers():
+            info = self.redis(["HGET", key, worker_id])
+            for x in hostnames:
+                if x in info:
+                    ret[x] = worker_id
+        return ret
+
+    def hash(self, key):
+        res = self.redis(["HGETALL", "{}:{}".format(self.queue_id, key)])
+        values = res.splitlines()
+        return dict(zip(values[::2], values[1::2]))
+
+
+def redis_cli(container):
+    def run(args):
+        res = docker_util.exec_safely(container, ["redis-cli"] + args)
+        # Values written by rrq may be serialised R objects
+        return res.output.decode("UTF-8", errors="replace")
+    return run
+
+
+# hintr_stop in the api asks every worker to exit once it finishes its
+# current job, so no new jobs are started. Workers that have exited
+# are removed straight away and the rest are given until the deadline
+# for their jobs to finish; anything still running after that is lost.
+def hintr_drain(obj, remote=None):
+    drain = hintr_stop_workers(obj, remote)
+    if drain:
+        worker_drain(*drain, obj.data.hintr_drain_timeout)
+
+
+# Returns the queue, the containers of the workers that were asked to
+# stop and their ids in the queue, for worker_drain to wait on.
+def hintr_stop_workers(obj, remote=None):
+    cfg = obj.data
+    redis = obj.containers.get("redis", obj.prefix)
+    if not redis or redis.status != "running":
+        print("[drain] redis is not running, not waiting for workers")
+        return None
+    for container in obj.containers.find("hintr-api").get(obj.prefix):
+        if container and container.status == "running":
+            print("Stopping {}".format(container.name))
+            container.exec_run(["hintr_stop"])
+    workers = [x for pool in cfg.hintr_worker_pools
+               for x in obj.containers.find(pool.name).get(obj.prefix, True)
+               if x]
+    for x in remote or []:
+        workers += x.containers()
+    queue = WorkerQueue(redis_cli(redis), cfg.hintr_queue_id)
+    return queue, workers, queue.workers()
+
+
+def worker_drain(queue, workers, ids, timeout, poll=5, report=60):
+    t0 = time.time()
+    reported = None
+    while True:
+        for container in list(workers):
+            container.reload()
+            if container.status != "running":
+                print("[drain] Removing drained {}".format(container.name))
+                container.remove(force=True)
+                workers.remove(container)
+        busy = queue.busy(ids)
+        elapsed = time.time() - t0
+        if not busy or not workers:
+            break
+        if elapsed >= timeout:
+            print("[drain] Gave up after {:.0f}s; interrupting {} job(s): "
+                  "{}".format(elapsed, len(busy), worker_jobs(busy)))
+            break
+        if reported is None or elapsed - reported >= report:
+            print("[drain] Waiting for {} job(s) in flight ({:.0f}s of "
+                  "{}s): {}".format(len(busy), elapsed, timeout,
+                                    worker_jobs(busy)))
+            reported = elapsed
+        time.sleep(poll)
+    for container in workers:
+        print("[drain] Removing {}".format(container.name))
+        container.remove(force=True)
+
+
+def worker_jobs(busy):
+    return ", ".join("{} ({})".format(k, v) for k, v in sorted(busy.items()))
+
+
+def hint_scale(obj, name, count):
+    pools = [x.name for x in obj.data.hintr_worker_pools]
+    if name not in pools:
+        raise Exception("'{}' is not a worker pool (one of {})".format(
+            name, ", ".join(pools)))
+    service = obj.containers.find(name)
+    current = service.get(obj.prefix)
+    print("Scaling {} from {} to {}".format(name, len(current), count))
+    if count > len(current):
+        extra = constellation.ConstellationService(
+            service.name, service.image, count - len(current),
+            **service.kwargs)
+        extra.start(obj.prefix, obj.network, obj.volumes, obj.data)
+    if count < len(current):
+        redis = obj.containers.get("redis", obj.prefix)
+        queue = WorkerQueue(redis_cli(redis), obj.data.hintr_queue_id)
+        remove = worker_scale_down(queue, current, len(current) - count,
+                                   obj.data.hintr_drain_timeout)
+        for container in remove:
+            docker_util.container_stop(container, False, container.name)
             docker_util.container_remove_wait(container)
-    print("Killing {}".format(loadbalancer_container.name))
-    docker_util.container_stop(
-        loadbalancer_container, True, loadbalancer_container.name)
-    docker_util.container_remove_wait(loadbalancer_container)
-
-    obj.start(subset=[loadbalancer.name, hintr_api.name,
-              calibrate_worker.name, worker.name])
-    loadbalancer_register_hintr_api(obj)
 
 
-def hint_upgrade_all(obj, db_tag):
-    pull_migrate_image(db_tag)
-    obj.restart(pull_images=True)
-    loadbalancer_register_hintr_api(obj)
+# Picks the replicas to remove when scaling down, preferring idle ones
+# and otherwise waiting for jobs to finish, so that a long fit is not
+# killed. Replicas whose worker can't be found in the queue are taken
+# to be idle.
+def worker_scale_down(queue, containers, n, timeout, poll=5, report=60):
+    t0 = time.time()
+    reported = None
+    hostname = {x.name: x.attrs["Config"]["Hostname"] for x in containers}
+    while True:
+        hosts = queue.hosts(list(hostname.values()))
+        busy = queue.busy()
+        idle = [x for x in containers
+                if hosts.get(hostname[x.name]) not in busy]
+        elapsed = time.time() - t0
+        if len(idle) >= n:
+            return idle[:n]
+        jobs = {k: v for k, v in busy.items() if k in hosts.values()}
+        if elapsed >= timeout:
+            print("[scale] Gave up after {:.0f}s; interrupting: {}".format(
+                elapsed, worker_jobs(jobs)))
+            return idle + [x for x in containers if x not in idle][
+                :n - len(idle)]
+        if reported is None or elapsed - reported >= report:
+            print("[scale] {} of {} workers to remove are idle; waiting "
+                  "({:.0f}s of {}s) for: {}".format(
+                      len(idle), n, elapsed, timeout, worker_jobs(jobs)))
+            reported = elapsed
+        time.sleep(poll)
 
 
-def hint_stop(obj, args):
+def hint_upgrade_all(obj, db_tag, blue_green=False, record=None):
+    with phase(record, "pull"):
+        pull_migrate_image(db_tag)
+    if blue_green:
+        refs = hintr_refs(obj.data) + [str(obj.data.hint_ref)]
+        upgrade_gated(obj.data, refs,
+                      lambda: hint_upgrade_blue_green(obj, True, record),
+                      lambda: hint_upgrade_blue_green(obj, False, record),
+                      record=record)
+        return
+    # The migrate image is not rolled back, as the schema it applied
+    # stays in place.
+    refs = sorted(set(str(x.image) for x in obj.containers.collection))
+
+    def restart(pull):
+        remote = hint_remote_workers(obj.data)
+        with phase(record, "pull"):
+            if pull:
+                obj.containers.pull_images()
+        with phase(record, "drain"):
+            hintr_drain(obj, remote)
+        with phase(record, "remote"):
+            for x in remote:
+                x.stop()
+        with phase(record, "redis"):
+            redis_compact(obj)
+        with phase(record, "restart"):
+            hint_stop_tiers(obj)
+            obj.start()
+        with phase(record, "loadbalancer"):
+            loadbalancer_register_hintr_api(obj)
+        with phase(record, "remote"):
+            for x in remote:
+                x.start(pull)
+
+    upgrade_gated(obj.data, refs,
+                  lambda: restart(True), lambda: restart(False),
+                  record=record)
+
+
+# Upgrades hint and hintr while db, redis and the proxy keep
+# running. hintr is replaced as in 'upgrade hintr', and a new hint
+# container is brought up alongside the old one before the proxy is
+# switched over to it.
+def hint_upgrade_blue_green(obj, pull, record=None):
+    cfg = obj.data
+    print("Upgrading hint and hintr only; db, redis and proxy are kept")
+    if obj.vault_config:
+        vault.resolve_secrets(cfg, obj.vault_config.client())
+    with phase(record, "pull"):
+        if pull:
+            obj.containers.find("hint").pull_image()
+    with phase(record, "migrate"):
+        db_migrate(obj.containers.get("db", obj.prefix), cfg)
+    hintr_replace(obj, pull, record)
+    with phase(record, "hint"):
+        hint_blue_green(obj)
+
+
+def hint_blue_green(obj):
+    hint = obj.containers.find("hint")
+    old = hint.get(obj.prefix)
+    alias = rand_str(8, "hint-")
+    green = hint_candidate(obj, alias, None)
+    hint_switch(obj, old, green, alias)
+    # Published ports cannot be added to a running container, so if
+    # hint is exposed we hop once more onto a container created with
+    # the usual name and ports.
+    ports = hint_ports(obj.data)
+    if ports:
+        final = hint_candidate(obj, hint.name, ports)
+        hint_switch(obj, green, final, None)
+    else:
+        green.rename(hint.name_external(obj.prefix))
+
+
+def hint_candidate(obj, name, ports):
+    hint = obj.containers.find("hint")
+    loadbalancer = obj.containers.get("hintr", obj.prefix)
+    candidate = constellation.ConstellationContainer(
+        name, hint.image, mounts=hint.mounts, ports=ports,
+        environment=hint.environment)
+    candidate.start(obj.prefix, obj.network, obj.volumes)
+    container = candidate.get(obj.prefix)
+    # The final container is started with the 'hint' alias, which
+    # still also points at green until the switch, so it is probed by
+    # its own container name, which is unique on the network.
+    hint_configure(container, obj.data,
+                   lambda: hint_responsive_from(loadbalancer, container.name))
+    return container
+
+
+# Once the new container carries the 'hint' alias the proxy resolves
+# the upstream to both containers on reload, so requests that hit the
+# old one while it stops are retried against the new one.
+def hint_switch(obj, old, new, alias):
+    print("[hint] Switching proxy from {} to {}".format(old.name, new.name))
+    proxy = obj.containers.get("proxy", obj.prefix)
+    if alias:
+        network = docker.client.from_env().networks.get(obj.network.name)
+        network.disconnect(new)
+        network.connect(new, aliases=["hint", alias])
+    proxy_reload(proxy)
+    docker_util.container_stop(old, False, old.name)
+    docker_util.container_remove_wait(old)
+    proxy_reload(proxy)
+
+
+def hint_responsive_from(container, host):
+    url = "http://{}:8080".format(host)
+    return container.exec_run(["curl", "-sf", "-o", "/dev/null", url])[0] == 0
+
+
+def hint_ports(cfg):
+    return [8080] if cfg.hint_expose else None
+
+
+def hint_status(obj, cfg):
+    obj.status()
+    for x in redis_instances(cfg):
+        print("Redis '{}' ({}): {}".format(
+            x["name"], x["url"], x["description"]))
+    remote = hint_remote_workers(cfg)
+    if remote:
+        print("Workers on other docker endpoints:")
+        for x in remote:
+            x.status()
+
+
+def hint_stop(obj, args, record=None):
     # Loadbalancer can take >10s to stop if we stop it via
     # docker stop making the ./hint stop error
     # We don't rely on saving any data from the loadbalancer
@@ -253,7 +1083,63 @@ def hint_stop(obj, args):
     docker_util.container_stop(
         loadbalancer_container, True, loadbalancer_container.name)
     docker_util.container_remove_wait(loadbalancer_container)
-    obj.stop(**args)
+    remote = hint_remote_workers(obj.data)
+    if not args["kill"]:
+        with phase(record, "drain"):
+            hintr_drain(obj, remote)
+    with phase(record, "remote"):
+        for x in remote:
+            x.stop(args["kill"])
+    if not args["kill"]:
+        with phase(record, "redis"):
+            redis_compact(obj)
+    with phase(record, "stop"):
+        hint_stop_tiers(obj, args["kill"])
+        if args["remove_network"]:
+            obj.network.remove()
+        if args["remove_volumes"]:
+            obj.volumes.remove()
+
+
+# Stops each tier of containers in parallel, giving each container the
+# tier's timeout to shut down cleanly before docker kills it.
+def hint_stop_tiers(obj, kill=False):
+    named = [x for names in STOP_TIERS.values() if names for x in names]
+    for tier, names in STOP_TIERS.items():
+        containers = []
+        for x in obj.containers.collection:
+            if (x.name in names) if names else (x.name not in named):
+                if isinstance(x, constellation.ConstellationService):
+                    found = x.get(obj.prefix, True)
+                else:
+                    found = [x.get(obj.prefix)]
+                containers += [(x.name, c) for c in found if c]
+        timeout = obj.data.stop_timeouts[tier]
+        t0 = time.time()
+        with concurrent.futures.ThreadPoolExecutor(
+                max(len(containers), 1)) as pool:
+            futures = [pool.submit(container_stop_remove, c, name, kill,
+                                   timeout)
+                       for name, c in containers]
+            for f in futures:
+                f.result()
+        print("[stop] Stopped {} tier ({} containers) in {:.1f}s".format(
+            tier, len(containers), time.time() - t0))
+
+
+def container_stop_remove(container, name, kill, timeout):
+    try:
+        if container.status == "running":
+            if kill:
+                print("Killing '{}'".format(name))
+                container.kill()
+            else:
+                print("Stop '{}'".format(name))
+                container.stop(timeout=timeout)
+        print("Removing '{}'".format(name))
+        container.remove()
+    except docker.errors.NotFound:
+        pass
 
 
 def pull_migrate_image(db_tag):
@@ -276,37 +1162,284 @@ def hint_user(cfg, action, email, pull, password=None):
     hint_user_run(ref, args, cfg)
 
 
+# The cli reads hint's config.properties, but like migrations it
+# should go straight to the db rather than through pgbouncer, so it is
+# given a copy of the deployed file with the db_url replaced.
 def hint_user_run(ref, args, cfg):
     client = docker.client.from_env()
     config_volume = cfg.volumes["config"]
-    mounts = [docker.types.Mount(config_volume["path"], config_volume["name"],
+    mounts = [docker.types.Mount(HINT_CONFIG_DEPLOYED, config_volume["name"],
                                  read_only=True)]
-    res = client.containers.run(str(ref), args, network=cfg.network,
-                                mounts=mounts, remove=True, detach=False)
-    output = res.decode("UTF-8").rstrip()
+    container = client.containers.create(str(ref), args, network=cfg.network,
+                                         mounts=mounts)
+    try:
+        properties = docker_util.string_from_container(
+            container, HINT_CONFIG_DEPLOYED + "/config.properties")
+        properties = properties_set(properties, "db_url", DB_URL_DIRECT)
+        with docker_util.simple_tar_string(
+                properties,
+                config_volume["path"].lstrip("/") + "/config.properties") \
+                as tar:
+            container.put_archive("/", tar)
+        container.start()
+        status = container.wait()["StatusCode"]
+        output = container.logs().decode("UTF-8").rstrip()
+    finally:
+        container.remove(force=True)
     print(output)
+    if status != 0:
+        raise Exception("hint user cli failed with status {}".format(status))
     return output
 
 
+def properties_set(properties, key, value):
+    lines = [x for x in properties.splitlines()
+             if not x.startswith(key + "=")]
+    return "".join(x + "\n" for x in lines + ["{}={}".format(key, value)])
+
+
+# Data fixes connect straight to the db rather than through pgbouncer,
+# as they hold transactions open across many statements. Downloaded
+# dependencies and checkpoints are kept in the data_fix volume, so
+# later runs neither re-download jars nor redo finished batches.
+def hint_data_fix(cfg, script, batch_size, parallel, reset):
+    name = os.path.splitext(os.path.basename(script))[0]
+    if not os.path.exists(os.path.join(DATA_FIX_SCRIPTS, name + ".groovy")):
+        raise Exception("No data fix script '{}' in {}".format(
+            name, DATA_FIX_SCRIPTS))
+    volume = cfg.volumes["data_fix"]
+    mounts = [docker.types.Mount("/home/groovy/scripts", DATA_FIX_SCRIPTS,
+                                 type="bind", read_only=True),
+              docker.types.Mount(volume["path"], volume["name"])]
+    env = {"DB_URL": "jdbc:postgresql://db/hint",
+           "DB_USER": DB_USER,
+           "DB_PASSWORD": DB_PASSWORD,
+           "DATA_FIX_BATCH_SIZE": str(batch_size),
+           "DATA_FIX_PARALLEL": str(parallel),
+           "DATA_FIX_RESET": str(reset).lower(),
+           "DATA_FIX_CHECKPOINTS": volume["path"] + "/checkpoints",
+           "JAVA_OPTS": "-Dgrape.root=" + volume["path"]}
+    args = ["groovy", "-cp", "/home/groovy/scripts", name + ".groovy"]
+    print("Running data fix '{}'".format(name))
+    client = docker.client.from_env()
+    # Run as root so that the script can write to the fresh volume
+    container = client.containers.run(
+        DATA_FIX_IMAGE, args, network=cfg.network, mounts=mounts,
+        environment=env, working_dir="/home/groovy/scripts", user="root",
+        detach=True)
+    try:
+        for line in container.logs(stream=True, follow=True):
+            print(line.decode("UTF-8"), end="")
+        status = container.wait()["StatusCode"]
+    finally:
+        container.remove(force=True)
+    if status != 0:
+        raise Exception("Data fix '{}' failed; rerun to resume from "
+                        "the last checkpoint".format(name))
+
+
+def hint_db_url(cfg):
+    if not cfg.pgbouncer_enabled:
+        return DB_URL_DIRECT
+    url = "jdbc:postgresql://pgbouncer/hint"
+    # Server-side prepared statements are bound to a server
+    # connection, which pgbouncer only holds for a single transaction
+    # in the transaction and statement pool modes.
+    if cfg.pgbouncer_pool_mode != "session":
+        url += "?prepareThreshold=0"
+    return url
+
+
 def redis_configure(container, cfg):
     print("[redis] Waiting for redis to come up")
     docker_util.file_into_container(
         "scripts/wait_for_redis", container, ".", "wait_for_redis")
-    docker_util.exec_safely(container, ["bash", "/wait_for_redis"])
+    t0 = time.time()
+    docker_util.exec_safely(container, ["bash", "/wait_for_redis",
+                                        str(cfg.redis_load_timeout)])
+    elapsed = time.time() - t0
+    for k, v in redis_persistence_settings(cfg).items():
+        docker_util.exec_safely(container,
+                                ["redis-cli", "CONFIG", "SET", k, v])
+    info = redis_info(container, "persistence")
+    print("[redis] Loaded data in {:.1f}s ({})".format(
+        elapsed, redis_persistence_size(info)))
+
+
+def redis_cache_configure(container, cfg):
+    print("[redis-cache] Waiting for redis cache to come up")
+    docker_util.file_into_container(
+        "scripts/wait_for_redis", container, ".", "wait_for_redis")
+    docker_util.exec_safely(container, ["bash", "/wait_for_redis",
+                                        str(cfg.redis_load_timeout)])
+    print("[redis-cache] Up, holding at most {} ({})".format(
+        cfg.redis_cache_maxmemory, cfg.redis_cache_maxmemory_policy))
+
+
+# Which redis holds what; only the durable instance is compacted on
+# stop and needs to be included in backups
+def redis_instances(cfg):
+    ret = [{"name": "redis", "durable": True, "url": "REDIS_URL",
+            "description": "durable job queue (AOF, appendfsync {})".format(
+                cfg.redis_appendfsync)}]
+    if cfg.redis_cache_enabled:
+        ret.append({"name": "redis-cache", "durable": False,
+                    "url": "REDIS_CACHE_URL",
+                    "description": "volatile cache ({}, {})".format(
+                        cfg.redis_cache_maxmemory,
+                        cfg.redis_cache_maxmemory_policy)})
+    return ret
+
+
+def redis_persistence_settings(cfg):
+    ret = {"appendfsync": cfg.redis_appendfsync,
+           "aof-use-rdb-preamble":
+           "yes" if cfg.redis_aof_use_rdb_preamble else "no",
+           "maxmemory-policy": cfg.redis_maxmemory_policy}
+    if cfg.redis_maxmemory:
+        ret["maxmemory"] = cfg.redis_maxmemory
+    return ret
+
+
+# Rewriting the AOF (or taking a snapshot if AOF is off) before
+# stopping means that the next start loads a compact file rather than
+# replaying every write since the last rewrite.
+def redis_compact(obj):
+    cfg = obj.data
+    container = obj.containers.get("redis", obj.prefix)
+    if not container or container.status != "running":
+        return
+    if redis_info(container, "persistence").get("aof_enabled") == "1":
+        print("[redis] Rewriting AOF before stopping")
+        command = "BGREWRITEAOF"
+        busy = ["aof_rewrite_in_progress", "aof_rewrite_scheduled"]
+    else:
+        print("[redis] Saving snapshot before stopping")
+        command = "BGSAVE"
+        busy = ["rdb_bgsave_in_progress"]
+    # This errors if a rewrite is already running, in which case we
+    # just wait for that one.
+    container.exec_run(["redis-cli", command])
+    t0 = time.time()
+
+    def finished():
+        info = redis_info(container, "persistence")
+        return all(info.get(k) == "0" for k in busy)
+
+    try:
+        wait(finished, "Redis did not finish writing in time",
+             timeout=cfg.redis_compact_timeout, poll=0.5)
+    except Exception as e:
+        print("[redis] WARNING: {}, stopping anyway".format(e))
+        return
+    info = redis_info(container, "persistence")
+    print("[redis] Finished writing in {:.1f}s ({})".format(
+        time.time() - t0, redis_persistence_size(info)))
+
+
+def redis_persistence_size(info):
+    if info.get("aof_enabled") == "1":
+        return "AOF {:.1f} MB".format(int(info["aof_current_size"]) / 1e6)
+    return "AOF disabled"
+
+
+def redis_info(container, section):
+    res = docker_util.exec_safely(container, ["redis-cli", "INFO", section])
+    ret = {}
+    for line in res.output.decode("UTF-8").splitlines():
+        if ":" in line and not line.startswith("#"):
+            k, v = line.strip().split(":", 1)
+            ret[k] = v
+    return ret
 
 
 def db_configure(container, cfg):
     print("[db] Waiting for db to come up")
     docker_util.exec_safely(container, ["wait-for-db"])
+    db_migrate_start(container, cfg)
+
+
+def db_migrate(container, cfg):
+    db_migrate_start(container, cfg)
+    db_migrate_wait(container.client, cfg)
+
+
+# Migrations run in the background while the remaining containers
+# start; hint_configure waits for them before hint needs the schema.
+def db_migrate_start(container, cfg):
+    migrate = str(constellation.ImageReference(
+        "mrcide", "hint-db-migrate", cfg.db_tag))
+    try:
+        image_id = container.client.images.get(migrate).id
+    except docker.errors.ImageNotFound:
+        image_id = None
+    if image_id and db_schema_fingerprint(container) == image_id:
+        print("[db] Schema is up to date with {}".format(migrate))
+        return
     print("[db] Migrating the database")
-    migrate = constellation.ImageReference(
-        "mrcide", "hint-db-migrate", cfg.db_tag)
+    name = db_migrate_name(cfg)
+    with docker_util.ignoring_missing():
+        container.client.containers.get(name).remove(force=True)
     args = ["-url=jdbc:postgresql://{}/hint".format(container.name)]
-    container.client.containers.run(str(migrate), args, network=cfg.network,
-                                    auto_remove=True, detach=False)
+    container.client.containers.run(migrate, args, name=name,
+                                    network=cfg.network, detach=True)
+
+
+def db_migrate_wait(client, cfg):
+    try:
+        migrate = client.containers.get(db_migrate_name(cfg))
+    except docker.errors.NotFound:
+        return
+    print("[db] Waiting for migrations to finish")
+    result = migrate.wait()
+    logs = migrate.logs().decode("UTF-8")
+    migrate.remove()
+    if result["StatusCode"] != 0:
+        print(logs)
+        raise Exception("Database migration failed (see above for log)")
+    db = client.containers.get("{}-db".format(cfg.prefix))
+    db_schema_fingerprint_set(db, migrate.image.id)
+
+
+def db_migrate_name(cfg):
+    return "{}-db-migrate".format(cfg.prefix)
+
+
+# The fingerprint is the id of the last migrate image that was run to
+# completion, stored as a comment on flyway's history table along with
+# the state of that table at the time. If either the image or the
+# applied history changes, the comment no longer matches.
+def db_schema_fingerprint(container):
+    res = db_schema_query(container, DB_SCHEMA_FINGERPRINT_SQL)
+    if res is None or " " not in res:
+        return None
+    image_id, state = res.split(" ", 1)
+    if db_schema_query(container, DB_SCHEMA_STATE_SQL) != state:
+        return None
+    return image_id
+
+
+def db_schema_fingerprint_set(container, image_id):
+    state = db_schema_query(container, DB_SCHEMA_STATE_SQL)
+    sql = "COMMENT ON TABLE flyway_schema_history IS '{} {}'".format(
+        image_id, state)
+    db_schema_query(container, sql)
+
+
+def db_schema_query(container, sql):
+    args = ["psql", "-U", "postgres", "-d", "hint", "-tAc", sql]
+    code, output = container.exec_run(args)
+    return output.decode("UTF-8").strip() if code == 0 else None
+
+
+def pgbouncer_configure(container, cfg):
+    print("[pgbouncer] Waiting for pgbouncer to come up")
+    wait(lambda: container.exec_run(["nc", "-z", "localhost", "5432"])[0] == 0,
+         "pgbouncer did not become available in time")
 
 
-def hint_configure(container, cfg):
+def hint_configure(container, cfg, responsive=None):
+    db_migrate_wait(container.client, cfg)
     print("[hint] Configuring hint")
     config_path = cfg.volumes["config"]["path"]
     docker_util.exec_safely(container,
@@ -323,8 +1456,8 @@ def hint_configure(container, cfg):
         "email_password": cfg.hint_email_password,
         "upload_dir": cfg.volumes["uploads"]["path"],
         "hintr_url": "http://hintr:8888",
-        "db_url": "jdbc:postgresql://db/hint",
-        "db_password": "changeme",
+        "db_url": hint_db_url(cfg),
+        "db_password": DB_PASSWORD,
         "issue_report_url": cfg.hint_issue_report_url,
         "oauth2_client_id": cfg.hint_oauth2_client_id,
         "oauth2_client_secret": cfg.hint_oauth2_client_secret,
@@ -342,8 +1475,12 @@ def hint_configure(container, cfg):
     docker_util.string_into_container(config_str, container,
                                       config_path + "/config.properties")
     print("[hint] Waiting for hint to become responsive")
-    wait(lambda: requests.get("http://localhost:8080").status_code == 200,
-         "Hint did not become responsive in time")
+    if responsive is None:
+        def responsive():
+            return requests.get("http://localhost:8080").status_code == 200
+    elapsed = wait(responsive, "Hint did not become responsive in time")
+    print("[hint] Responsive after {:.1f}s".format(elapsed))
+    cfg.hint_responsive_seconds = elapsed
 
 
 def proxy_configure(container, cfg):
@@ -359,6 +1496,90 @@ def proxy_configure(container, cfg):
         args = ["self-signed-certificate", "/run/proxy",
                 "GB", "London", "IC", "reside", cfg.proxy_host]
         docker_util.exec_safely(container, args)
+    if cfg.proxy_performance:
+        proxy_configure_performance(container, cfg)
+
+
+# Written after the certificates so that 'nginx -t' can validate the
+# whole configuration. If nginx has not yet started (it waits for the
+# certificates) it will read the file on startup, otherwise we reload
+# it in place, which does not drop open connections.
+def proxy_configure_performance(container, cfg):
+    print("[proxy] Applying performance settings")
+    http, server = proxy_performance_conf(cfg)
+    docker_util.string_into_container(http, container,
+                                      PROXY_PERFORMANCE_CONF)
+    docker_util.string_into_container(server, container,
+                                      PROXY_PERFORMANCE_SERVER_CONF)
+    proxy_include_server_conf(container)
+    if container.exec_run(["test", "-f", "/var/run/nginx.pid"])[0] == 0:
+        proxy_reload(container)
+
+
+def proxy_reload(container):
+    docker_util.exec_safely(container, ["nginx", "-t"])
+    docker_util.exec_safely(container, ["nginx", "-s", "reload"])
+
+
+# The hint server block comes with the proxy image, so the server level
+# settings are included into it, just after its 'listen 443' line.
+def proxy_include_server_conf(container):
+    include = "include {};".format(PROXY_PERFORMANCE_SERVER_CONF)
+    script = ("for f in $(grep -rlE 'listen[[:space:]]+443' /etc/nginx); do "
+              "grep -qF '{include}' $f || "
+              "sed -i -E '/listen[[:space:]]+443/a {include}' $f; "
+              "done").format(include=include)
+    docker_util.exec_safely(container, ["sh", "-c", script])
+
+
+# Returns the http level configuration (only the map, which cannot go
+# in a server block) and the settings for the hint server block.
+# Anything not set in the configuration is left as the image has it,
+# as repeating a directive at the same level is an error in nginx.
+def proxy_performance_conf(cfg):
+    http = []
+    lines = []
+    if cfg.proxy_gzip_level > 0:
+        lines += ["gzip on;",
+                  "gzip_comp_level {};".format(cfg.proxy_gzip_level),
+                  "gzip_min_length 1024;",
+                  "gzip_proxied any;",
+                  "gzip_vary on;",
+                  "gzip_types {};".format(" ".join(PROXY_COMPRESS_TYPES))]
+    if cfg.proxy_brotli_level is not None:
+        # Requires the ngx_brotli module in the proxy image
+        lines += ["brotli on;",
+                  "brotli_comp_level {};".format(cfg.proxy_brotli_level),
+                  "brotli_types {};".format(" ".join(PROXY_COMPRESS_TYPES))]
+    # The 'http2' directive needs nginx >= 1.25.1
+    if cfg.proxy_http2 is not None:
+        lines.append("http2 {};".format("on" if cfg.proxy_http2 else "off"))
+    if cfg.proxy_ssl_session_cache:
+        lines.append("ssl_session_cache shared:hint_ssl:{};".format(
+            cfg.proxy_ssl_session_cache))
+    if cfg.proxy_ssl_session_timeout:
+        lines.append("ssl_session_timeout {};".format(
+            cfg.proxy_ssl_session_timeout))
+    if cfg.proxy_keepalive_timeout is not None:
+        lines.append("keepalive_timeout {};".format(
+            cfg.proxy_keepalive_timeout))
+    if cfg.proxy_keepalive_requests is not None:
+        lines.append("keepalive_requests {};".format(
+            cfg.proxy_keepalive_requests))
+    if cfg.proxy_static_max_age > 0:
+        # An empty value means that nginx does not add the header at
+        # all, so only static bundles pick up the cache policy.
+        cache_control = "public, max-age={}".format(cfg.proxy_static_max_age)
+        http += ["map $uri $hint_static_cache_control {",
+                 '    "~*\\.({})$" "{}";'.format(
+                     "|".join(PROXY_STATIC_EXTENSIONS), cache_control),
+                 '    default "";',
+                 "}"]
+        # At server level, as add_header at http level is ignored
+        # once the server block has an add_header of its own
+        lines.append("add_header Cache-Control $hint_static_cache_control;")
+    return ("".join(x + "\n" for x in http),
+            "".join(x + "\n" for x in lines))
 
 
 def ensure_hintr_online(loadbalancer, port, name, attempts=30):
@@ -388,10 +1609,11 @@ def loadbalancer_register_hintr_api(constellation):
 
 # It can take a while for the container to come up
 def wait(f, message, timeout=30, poll=0.1):
+    t0 = time.time()
     for i in range(math.ceil(timeout / poll)):
         try:
             if f():
-                return
+                return time.time() - t0
         except Exception:
             pass
         time.sleep(poll)
@@ -0,0 +1,126 @@
+import contextlib
+import docker
+import json
+import os
+import re
+import sys
+import threading
+import urllib.parse
+
+STATS_ENV = "HINT_DOCKER_STATS"
+
+# Collections whose next path segment names a particular object, and
+# the segments that are actions on the collection itself instead
+API_COLLECTIONS = ["containers", "exec", "images", "networks", "volumes"]
+API_ACTIONS = ["create", "json", "prune", "load", "search", "get"]
+
+_session = None
+
+
+class DockerStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    # Used as a requests response hook. Bytes received come from the
+    # Content-Length header, so streamed responses (pulls, logs and
+    # exec output) only count their calls and time to first byte.
+    def record(self, response, *args, **kwargs):
+        request = response.request
+        key = "{} {}".format(request.method, api_endpoint(request.path_url))
+        body = request.body or b""
+        with self.lock:
+            x = self.endpoints.setdefault(
+                key, {"calls": 0, "seconds": 0.0, "bytes_sent": 0,
+                      "bytes_received": 0})
+            x["calls"] += 1
+            x["seconds"] += response.elapsed.total_seconds()
+            x["bytes_sent"] += len(body)
+            x["bytes_received"] += int(
+                response.headers.get("Content-Length", 0))
+
+    def total(self):
+        ret = {"calls": 0, "seconds": 0.0, "bytes_sent": 0,
+               "bytes_received": 0}
+        for x in self.endpoints.values():
+            for k in ret.keys():
+                ret[k] += x[k]
+        return ret
+
+    def report(self, f):
+        total = self.total()
+        print("Docker API: {} calls in {:.2f}s ({} bytes sent, {} received)"
+              .format(total["calls"], total["seconds"], total["bytes_sent"],
+                      total["bytes_received"]), file=f)
+        rows = sorted(self.endpoints.items(), key=lambda x: -x[1]["seconds"])
+        for key, x in rows:
+            print("  {:>5} {:>8.3f}s {:>10} {}".format(
+                x["calls"], x["seconds"], x["bytes_received"], key), file=f)
+
+    # '1' or '-' prints the report to stderr, anything else is taken
+    # as a file to write the numbers to as json
+    def dump(self, dest):
+        if dest in ["1", "-"]:
+            self.report(sys.stderr)
+        else:
+            with open(dest, "w") as f:
+                json.dump({"total": self.total(),
+                           "endpoints": self.endpoints}, f, indent=2)
+
+
+def api_endpoint(path):
+    path = urllib.parse.urlparse(path).path
+    path = re.sub(r"^/v[0-9.]+/", "/", path)
+    # Image names contain slashes, so are matched from the end
+    m = re.match(r"^/images/(.+)/(json|tag|push|history|get)$", path)
+    if m:
+        return "/images/{{name}}/{}".format(m.group(2))
+    parts = path.split("/")
+    for i in range(1, len(parts) - 1):
+        if parts[i] in API_COLLECTIONS and parts[i + 1] not in API_ACTIONS:
+            parts[i + 1] = "{id}"
+    return "/".join(parts)
+
+
+def docker_instrument(client):
+    if _session:
+        client.api.hooks["response"].append(_session.record)
+    return client
+
+
+# Within a session every docker.client.from_env() call, including
+# those made inside constellation, returns the same client, so that
+# connections are pooled across the whole command and every API call
+# is counted.
+@contextlib.contextmanager
+def docker_session():
+    global _session
+    stats = DockerStats()
+    lock = threading.Lock()
+    client = None
+    from_env = docker.client.from_env
+    from_env_top = docker.from_env
+
+    def shared_from_env(**kwargs):
+        nonlocal client
+        if kwargs:
+            return docker_instrument(from_env(**kwargs))
+        with lock:
+            if client is None:
+                client = docker_instrument(from_env(max_pool_size=32))
+        return client
+
+    _session = stats
+    docker.client.from_env = shared_from_env
+    docker.from_env = shared_from_env
+    try:
+        yield stats
+    finally:
+        docker.client.from_env = from_env
+        docker.from_env = from_env_top
+        _session = None
+        if client:
+            client.close()
+        dest = os.environ.get(STATS_ENV)
+        if dest:
+            stats.dump(dest)
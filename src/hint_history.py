@@ -0,0 +1,181 @@
+import contextlib
+import datetime
+import docker
+import json
+import socket
+import sqlite3
+import statistics
+import time
+
+import constellation.docker_util as docker_util
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS deploy (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    time REAL NOT NULL,
+    action TEXT NOT NULL,
+    config_name TEXT,
+    host TEXT NOT NULL,
+    tags TEXT NOT NULL,
+    digests TEXT NOT NULL,
+    phases TEXT NOT NULL,
+    metrics TEXT NOT NULL DEFAULT '{}',
+    duration REAL NOT NULL,
+    outcome TEXT NOT NULL,
+    error TEXT
+)
+"""
+
+
+class DeployRecord:
+    def __init__(self, action, config_name, cfg):
+        self.time = time.time()
+        self.action = action
+        self.config_name = config_name
+        self.prefix = cfg.prefix
+        self.tags = {"hint": cfg.hint_tag,
+                     "hintr": cfg.hintr_tag,
+                     "db": cfg.db_tag,
+                     "redis": cfg.redis_tag,
+                     "hintr-loadbalancer": cfg.hintr_loadbalancer_tag}
+        if cfg.hint_jvm_options:
+            self.tags["hint-jvm"] = " ".join(cfg.hint_jvm_options)
+        self.cfg = cfg
+        self.phases = {}
+        self.metrics = {}
+        self.outcome = "success"
+        self.error = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.time() - t0
+
+    # Measurements taken while deploying, rather than durations of
+    # our own phases
+    def collect_metrics(self):
+        if self.cfg.hint_responsive_seconds is not None:
+            self.metrics["hint_responsive"] = self.cfg.hint_responsive_seconds
+
+    def fail(self, e):
+        self.outcome = "failure"
+        self.error = str(e)
+
+
+def phase(record, name):
+    return record.phase(name) if record else contextlib.nullcontext()
+
+
+def path_history(path):
+    return path + "/.history.sqlite"
+
+
+def history_connect(path):
+    con = sqlite3.connect(path_history(path))
+    con.execute(HISTORY_SCHEMA)
+    # Histories written before metrics were recorded
+    columns = [x[1] for x in con.execute("PRAGMA table_info(deploy)")]
+    if "metrics" not in columns:
+        con.execute("ALTER TABLE deploy "
+                    "ADD COLUMN metrics TEXT NOT NULL DEFAULT '{}'")
+    return con
+
+
+def history_append(path, record):
+    record.collect_metrics()
+    row = {"time": record.time,
+           "action": record.action,
+           "config_name": record.config_name,
+           "host": socket.gethostname(),
+           "tags": json.dumps(record.tags),
+           "digests": json.dumps(running_images(record.prefix)),
+           "phases": json.dumps(record.phases),
+           "metrics": json.dumps(record.metrics),
+           "duration": time.time() - record.time,
+           "outcome": record.outcome,
+           "error": record.error}
+    sql = "INSERT INTO deploy ({}) VALUES ({})".format(
+        ", ".join(row.keys()), ", ".join(":" + k for k in row.keys()))
+    con = history_connect(path)
+    try:
+        with con:
+            con.execute(sql, row)
+    finally:
+        con.close()
+
+
+def history_read(path):
+    con = history_connect(path)
+    con.row_factory = sqlite3.Row
+    try:
+        rows = con.execute("SELECT * FROM deploy ORDER BY time").fetchall()
+    finally:
+        con.close()
+    ret = []
+    for x in rows:
+        x = dict(x)
+        for k in ["tags", "digests", "phases", "metrics"]:
+            x[k] = json.loads(x[k])
+        ret.append(x)
+    return ret
+
+
+# Each deploy is compared against the median duration of the
+# preceding successful deploys of the same kind.
+def history_regressions(rows, threshold, window=10):
+    previous = {}
+    for x in rows:
+        durations = previous.setdefault(x["action"], [])
+        x["median"] = statistics.median(durations) if durations else None
+        x["regression"] = x["median"] is not None and \
+            x["duration"] > x["median"] * (1 + threshold / 100)
+        if x["outcome"] == "success":
+            durations.append(x["duration"])
+            del durations[:-window]
+    return rows
+
+
+def history_report(path, limit, threshold):
+    rows = history_regressions(history_read(path), threshold)
+    if not rows:
+        print("No deploys recorded")
+        return
+    print("Deploy history ({} most recent)".format(min(limit, len(rows))))
+    for x in rows[-limit:]:
+        when = datetime.datetime.fromtimestamp(x["time"])
+        flag = ""
+        if x["regression"]:
+            flag = "  ** {:+.0%} vs median {:.0f}s".format(
+                x["duration"] / x["median"] - 1, x["median"])
+        print("  {} {:<14} {:<10} {:<8} {:>6.0f}s  hint:{} hintr:{}{}".format(
+            when.strftime("%Y-%m-%d %H:%M"), x["action"],
+            x["config_name"] or "<base>", x["outcome"], x["duration"],
+            x["tags"].get("hint"), x["tags"].get("hintr"), flag))
+        phases = ", ".join("{} {:.0f}s".format(k, v)
+                           for k, v in x["phases"].items())
+        if phases:
+            print("      {}".format(phases))
+        if "hint_responsive" in x["metrics"]:
+            print("      hint responsive after {:.1f}s{}".format(
+                x["metrics"]["hint_responsive"],
+                "  (jvm: {})".format(x["tags"]["hint-jvm"])
+                if "hint-jvm" in x["tags"] else ""))
+    print("Trends (successful deploys)")
+    for action in sorted(set(x["action"] for x in rows)):
+        durations = [x["duration"] for x in rows
+                     if x["action"] == action and x["outcome"] == "success"]
+        if durations:
+            print("  {:<14} {} runs, median {:.0f}s, last {:.0f}s".format(
+                action, len(durations), statistics.median(durations),
+                durations[-1]))
+
+
+def running_images(prefix):
+    try:
+        containers = docker_util.containers_matching(prefix + "-", False)
+        return {x.attrs["Config"]["Image"]: x.image.id for x in containers}
+    except docker.errors.DockerException:
+        return {}
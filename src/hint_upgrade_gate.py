@@ -0,0 +1,143 @@
+import docker
+import json
+import math
+import os.path
+import requests
+import time
+
+from src.hint_history import phase
+
+
+def upgrade_gated(cfg, refs, upgrade, rollback, client=None, record=None,
+                  remote=None):
+    if not cfg.upgrade_gate:
+        upgrade()
+        return
+    client = client or docker.client.from_env()
+    # Workers placed on other endpoints run images pulled there, so
+    # their tags need to be put back too
+    if remote is None:
+        remote = [x.client() for x in cfg.docker_endpoints.values()]
+    previous = [(x, image_digests(refs, x)) for x in [client] + remote]
+    with phase(record, "baseline"):
+        baseline = upgrade_gate_baseline(cfg)
+
+    # A build that fails to come up at all is rolled back too
+    try:
+        upgrade()
+    except Exception as e:
+        print("[gate] Upgrade failed: {}".format(e))
+        gate_rollback(previous, rollback, record)
+        raise
+
+    print("[gate] Probing upgraded deployment")
+    with phase(record, "probe"):
+        result = probe(cfg.upgrade_gate_targets, cfg.upgrade_gate_requests)
+    print_probe(result)
+    breaches = gate_breaches(baseline, result,
+                             cfg.upgrade_gate_max_p95_ratio,
+                             cfg.upgrade_gate_slack_ms,
+                             cfg.upgrade_gate_max_error_rate)
+    if not breaches:
+        print("[gate] Upgrade passed")
+        return
+
+    for msg in breaches:
+        print("[gate] {}".format(msg))
+    gate_rollback(previous, rollback, record)
+    raise Exception("Upgrade failed the latency gate and was rolled back")
+
+
+def gate_rollback(previous, rollback, record):
+    print("[gate] Rolling back to previous images")
+    for x, digests in previous:
+        image_restore(digests, x)
+    with phase(record, "rollback"):
+        rollback()
+
+
+# Measure the running deployment before we touch it; if it is
+# already unhealthy we fall back on the last good baseline instead.
+def upgrade_gate_baseline(cfg):
+    path = path_upgrade_baseline(cfg.path)
+    print("[gate] Probing current deployment for baseline")
+    result = probe(cfg.upgrade_gate_targets, cfg.upgrade_gate_requests)
+    print_probe(result)
+    healthy = all(x["error_rate"] <= cfg.upgrade_gate_max_error_rate
+                  for x in result.values())
+    if healthy:
+        with open(path, "w") as f:
+            json.dump(result, f)
+        return result
+    if os.path.exists(path):
+        print("[gate] Current deployment is unhealthy, using stored baseline")
+        with open(path, "r") as f:
+            return json.load(f)
+    print("[gate] Current deployment is unhealthy and no baseline is stored")
+    return {}
+
+
+def path_upgrade_baseline(path):
+    return path + "/.upgrade_baseline.json"
+
+
+def probe(targets, n, timeout=10):
+    ret = {}
+    for name, url in targets.items():
+        times = []
+        errors = 0
+        for i in range(n):
+            t0 = time.perf_counter()
+            try:
+                ok = requests.get(url, timeout=timeout).status_code < 500
+            except requests.exceptions.RequestException:
+                ok = False
+            times.append((time.perf_counter() - t0) * 1000)
+            errors += not ok
+        ret[name] = {"p95": percentile(times, 95), "error_rate": errors / n}
+    return ret
+
+
+def print_probe(result):
+    for name, x in result.items():
+        print("    - {}: p95 {:.0f}ms, {:.0%} errors".format(
+            name, x["p95"], x["error_rate"]))
+
+
+def gate_breaches(baseline, result, max_p95_ratio, slack_ms, max_error_rate):
+    ret = []
+    for name, x in result.items():
+        if x["error_rate"] > max_error_rate:
+            ret.append("{} error rate {:.0%} exceeds {:.0%}".format(
+                name, x["error_rate"], max_error_rate))
+        if name in baseline:
+            limit = baseline[name]["p95"] * max_p95_ratio + slack_ms
+            if x["p95"] > limit:
+                ret.append("{} p95 {:.0f}ms exceeds {:.0f}ms".format(
+                    name, x["p95"], limit))
+    return ret
+
+
+def percentile(x, p):
+    x = sorted(x)
+    return x[max(math.ceil(p / 100 * len(x)) - 1, 0)]
+
+
+def image_digests(refs, client):
+    ret = {}
+    for ref in refs:
+        try:
+            ret[ref] = client.images.get(ref).id
+        except docker.errors.ImageNotFound:
+            pass
+    return ret
+
+
+# Pointing the tag back at the old image means that containers
+# started from the same configuration pick the previous build up
+# again, without needing to know anything about registry digests.
+def image_restore(digests, client):
+    for ref, image_id in digests.items():
+        repository, tag = ref.rsplit(":", 1)
+        print("    - {} -> {}".format(ref, image_id[:19]))
+        client.images.get(image_id).tag(repository, tag)
@@ -25,6 +25,9 @@ def test_cli_parse():
         ("config", "staging", "start", {"pull_images": False},
          {"hintr": {"tag": "mrc-123"}, "hint": {"tag": "mrc-456"}})
 
+    assert hint_cli.parse(["scale", "worker", "4"]) == \
+        ("config", None, "scale", {"name": "worker", "count": 4}, {})
+
     assert hint_cli.parse(["stop"]) == \
         ("config", None, "stop", {"kill": False, "remove_network": False,
                                   "remove_volumes": False}, {})
@@ -38,6 +41,21 @@ def test_cli_parse():
 
     assert hint_cli.parse(["status"]) == ("config", None, "status", {}, {})
 
+    assert hint_cli.parse(["data-fix", "lowercase_user_ids"]) == \
+        ("config", None, "data_fix",
+         {"script": "lowercase_user_ids", "batch_size": 500, "parallel": 4,
+          "reset": False}, {})
+    assert hint_cli.parse(["data-fix", "--batch-size=100", "--parallel=1",
+                           "--reset", "lowercase_user_ids"]) == \
+        ("config", None, "data_fix",
+         {"script": "lowercase_user_ids", "batch_size": 100, "parallel": 1,
+          "reset": True}, {})
+
+    assert hint_cli.parse(["history"]) == \
+        ("config", None, "history", {"limit": 20, "threshold": 25.0}, {})
+    assert hint_cli.parse(["history", "--limit=5", "--threshold=10"]) == \
+        ("config", None, "history", {"limit": 5, "threshold": 10.0}, {})
+
     email = "user@example.com"
     password = "password"
     assert hint_cli.parse(["user", "add", email]) == \
@@ -57,7 +75,9 @@ def test_cli_parse():
     assert hint_cli.parse(["upgrade", "hintr"]) == \
         ("config", None, "upgrade_hintr", {}, {})
     assert hint_cli.parse(["upgrade", "all"]) == \
-        ("config", None, "upgrade_all", {}, {})
+        ("config", None, "upgrade_all", {"blue_green": False}, {})
+    assert hint_cli.parse(["upgrade", "--blue-green", "all"]) == \
+        ("config", None, "upgrade_all", {"blue_green": True}, {})
     assert hint_cli.parse(["upgrade", "hintr", "--hintr-branch=mrc-123"]) == \
         ("config", None, "upgrade_hintr", {}, {"hintr": {"tag": "mrc-123"}})
     assert hint_cli.parse(["upgrade", "hintr", "--hintr-branch=mrc-123",
@@ -76,12 +96,15 @@ def test_user_args_passed_to_hint_user():
                               "pull": False, "password": None}
 
 
-def test_args_passed_to_start():
+@mock.patch('src.hint_cli.history_append')
+def test_args_passed_to_start(history):
     with mock.patch('src.hint_cli.hint_start') as f:
         hint_cli.main(["start", "staging"])
 
     assert f.called
     assert f.call_args[0][2] == {"pull_images": False}
+    assert history.call_args[0][1].action == "start"
+    assert history.call_args[0][1].outcome == "success"
 
     with mock.patch('src.hint_cli.hint_start') as f:
         hint_cli.main(["start", "staging", "--pull"])
@@ -98,6 +121,55 @@ def test_other_args_passed_to_start():
         assert instance.status.called
 
 
+def test_failed_deploy_recorded_in_history():
+    with mock.patch('src.hint_cli.history_append') as history:
+        with mock.patch('src.hint_cli.hint_upgrade_hintr') as f:
+            f.side_effect = Exception("some error")
+            with pytest.raises(Exception, match="some error"):
+                hint_cli.main(["upgrade", "hintr"])
+
+    record = history.call_args[0][1]
+    assert record.action == "upgrade_hintr"
+    assert record.outcome == "failure"
+    assert record.error == "some error"
+
+
+def test_history_does_not_need_constellation():
+    with mock.patch('src.hint_cli.history_report') as f:
+        with mock.patch('src.hint_cli.hint_constellation') as obj:
+            hint_cli.main(["history", "--limit=5"])
+
+    assert not obj.called
+    assert f.call_args == mock.call("config", limit=5, threshold=25.0)
+
+
+@mock.patch('src.hint_cli.history_append')
+def test_blue_green_passed_to_upgrade_all(history):
+    with mock.patch('src.hint_cli.hint_upgrade_all') as f:
+        hint_cli.main(["upgrade", "--blue-green", "all"])
+
+    assert f.called
+    assert f.call_args[1]["blue_green"]
+
+
+def test_args_passed_to_scale():
+    with mock.patch('src.hint_cli.hint_scale') as f:
+        hint_cli.main(["scale", "calibrate-worker", "3"])
+
+    assert f.called
+    assert f.call_args[1] == {"name": "calibrate-worker", "count": 3}
+
+
+def test_args_passed_to_data_fix():
+    with mock.patch('src.hint_cli.hint_data_fix') as f:
+        hint_cli.main(["data-fix", "--parallel=2", "lowercase_user_ids"])
+
+    assert f.called
+    assert f.call_args[1] == {"script": "lowercase_user_ids",
+                              "batch_size": 500, "parallel": 2,
+                              "reset": False}
+
+
 def test_verify_data_loss_silent_if_no_loss():
     cfg = hint_deploy.HintConfig("config")
     f = io.StringIO()
@@ -1,4 +1,14 @@
+import io
+import os
 import pytest
+import shutil
+
+from contextlib import redirect_stdout
+from docker.models.containers import ExecResult
+from unittest import mock
+
+import constellation
+
 from src import hint_cli, hint_deploy
 
 
@@ -34,11 +44,9 @@ def test_proxy_url_drops_port_appropriately():
 def test_load_and_reload_config():
     path = "config"
     config = "production"
-    cfg = hint_deploy.HintConfig(path, config)
-    cfg.hint_tag = "develop"
-    hint_cli.save_config(path, config, cfg)
+    hint_cli.save_config(path, config)
 
-    hint_cli.read_config(path)
+    assert set(hint_cli.read_config(path).keys()) == {"config_name", "time"}
 
     config_name, config_value = hint_cli.load_config(path, None)
     assert config_value.hint_tag == "master"
@@ -56,6 +64,69 @@ def test_load_config_sets_branch_refs():
     assert cfg.hintr_tag == "mrc-456"
 
 
+def test_config_cache(tmp_path, monkeypatch):
+    path = str(tmp_path)
+    shutil.copy("config/hint.yml", path)
+    shutil.copy("config/staging.yml", path)
+    cfg = hint_cli.build_config(path, "staging")
+    assert os.listdir(hint_cli.path_config_cache(path)) == \
+        [hint_cli.config_cache_key(path, "staging", None)]
+
+    with mock.patch("src.hint_cli.HintConfig") as build:
+        cached = hint_cli.build_config(path, "staging")
+    assert not build.called
+    assert cached.hint_tag == cfg.hint_tag
+    assert cached.proxy_host == cfg.proxy_host
+
+    options = {"hint": {"tag": "mrc-123"}}
+    assert hint_cli.build_config(path, "staging", options).hint_tag == \
+        "mrc-123"
+    assert hint_cli.build_config(path, None).proxy_host == "localhost"
+    assert len(os.listdir(hint_cli.path_config_cache(path))) == 3
+
+    key = hint_cli.config_cache_key(path, "staging", None)
+    with open(os.path.join(path, "staging.yml"), "a") as f:
+        f.write("\n# changed\n")
+    assert hint_cli.config_cache_key(path, "staging", None) != key
+
+    # The staging configuration refers to the vault auth env vars
+    monkeypatch.setenv("VAULT_AUTH_ROLE_ID", "other")
+    key = hint_cli.config_cache_key(path, "staging", None)
+    monkeypatch.setenv("VAULT_AUTH_ROLE_ID", "another")
+    assert hint_cli.config_cache_key(path, "staging", None) != key
+
+
+def test_config_cache_does_not_store_env_values(tmp_path, monkeypatch):
+    path = str(tmp_path)
+    shutil.copy("config/hint.yml", path)
+    shutil.copy("config/staging.yml", path)
+    monkeypatch.setenv("VAULT_AUTH_ROLE_ID", "role-id-value")
+    monkeypatch.setenv("VAULT_AUTH_SECRET_ID", "secret-id-value")
+    cfg = hint_cli.build_config(path, "staging")
+    filename = os.path.join(hint_cli.path_config_cache(path),
+                            hint_cli.config_cache_key(path, "staging", None))
+    with open(filename, "rb") as f:
+        contents = f.read()
+    assert b"secret-id-value" not in contents
+    assert b"role-id-value" not in contents
+
+    with mock.patch("src.hint_cli.HintConfig") as build:
+        cached = hint_cli.build_config(path, "staging")
+    assert not build.called
+    assert cached.vault.auth_args == cfg.vault.auth_args
+
+
+def test_config_cache_is_pruned(tmp_path):
+    cache = str(tmp_path)
+    for i in range(hint_cli.CONFIG_CACHE_SIZE + 5):
+        p = os.path.join(cache, str(i))
+        open(p, "w").close()
+        os.utime(p, (i, i))
+    hint_cli.config_cache_prune(cache)
+    assert sorted(int(x) for x in os.listdir(cache)) == \
+        list(range(5, hint_cli.CONFIG_CACHE_SIZE + 5))
+
+
 def test_ensure_online_raises_exception_if_no_hintr():
     cfg = hint_deploy.HintConfig("config")
     obj = hint_deploy.hint_constellation(cfg)
@@ -70,3 +141,572 @@ def test_ensure_online_raises_exception_if_no_hintr():
                        match=f"hintr worker {name} did not come up in time"):
         hint_deploy.ensure_hintr_online(loadbalancer, port, name, 1)
     obj.destroy()
+
+
+def test_proxy_performance_is_optional():
+    cfg = hint_deploy.HintConfig("config")
+    assert not cfg.proxy_performance
+    cfg = hint_deploy.HintConfig("config", "staging")
+    assert cfg.proxy_performance
+    assert cfg.proxy_gzip_level == 5
+    assert cfg.proxy_static_max_age == 604800
+
+
+def test_proxy_performance_conf():
+    options = {"proxy": {"performance": {"gzip_level": 6,
+                                         "brotli_level": 4,
+                                         "http2": False,
+                                         "ssl_session_cache": "10m",
+                                         "keepalive_requests": 1000,
+                                         "static_max_age": 3600}}}
+    cfg = hint_deploy.HintConfig("config", options=options)
+    http, server = hint_deploy.proxy_performance_conf(cfg)
+    lines = server.split("\n")
+    assert "gzip_comp_level 6;" in lines
+    assert "brotli_comp_level 4;" in lines
+    assert "http2 off;" in lines
+    assert "ssl_session_cache shared:hint_ssl:10m;" in lines
+    assert "keepalive_requests 1000;" in lines
+    assert "add_header Cache-Control $hint_static_cache_control;" in lines
+    assert "keepalive_timeout" not in server
+    assert "ssl_session_timeout" not in server
+    assert '    "~*\\.(js|css|png|svg|ico|woff|woff2)$" ' \
+        '"public, max-age=3600";' in http.split("\n")
+    assert "add_header" not in http
+
+    options = {"proxy": {"performance": {"gzip_level": 0}}}
+    cfg = hint_deploy.HintConfig("config", options=options)
+    http, server = hint_deploy.proxy_performance_conf(cfg)
+    assert http == ""
+    assert server == ""
+
+
+def test_pgbouncer_is_optional():
+    cfg = hint_deploy.HintConfig("config")
+    assert not cfg.pgbouncer_enabled
+    assert hint_deploy.hint_db_url(cfg) == "jdbc:postgresql://db/hint"
+    obj = hint_deploy.hint_constellation(cfg)
+    with pytest.raises(Exception, match="'pgbouncer' not defined"):
+        obj.containers.find("pgbouncer")
+
+
+def test_pgbouncer_sits_between_hint_and_db():
+    options = {"pgbouncer": {"enabled": True, "pool_mode": "session",
+                             "pool_size": 5}}
+    cfg = hint_deploy.HintConfig("config", options=options)
+    assert hint_deploy.hint_db_url(cfg) == \
+        "jdbc:postgresql://pgbouncer/hint"
+    obj = hint_deploy.hint_constellation(cfg)
+    names = [x.name for x in obj.containers.collection]
+    assert names.index("db") < names.index("pgbouncer") < names.index("hint")
+    pgbouncer = obj.containers.find("pgbouncer")
+    assert pgbouncer.environment["DB_HOST"] == "db"
+    assert pgbouncer.environment["POOL_MODE"] == "session"
+    assert pgbouncer.environment["DEFAULT_POOL_SIZE"] == "5"
+
+    cfg.pgbouncer_pool_mode = "transaction"
+    assert hint_deploy.hint_db_url(cfg) == \
+        "jdbc:postgresql://pgbouncer/hint?prepareThreshold=0"
+
+
+def test_user_cli_properties_bypass_pgbouncer():
+    properties = ("db_url=jdbc:postgresql://pgbouncer/hint\n"
+                  "db_password=changeme\n")
+    res = hint_deploy.properties_set(properties, "db_url",
+                                     hint_deploy.DB_URL_DIRECT)
+    assert res == ("db_password=changeme\n"
+                   "db_url=jdbc:postgresql://db/hint\n")
+
+
+def test_worker_pools():
+    cfg = hint_deploy.HintConfig("config", "production")
+    pools = {x.name: x for x in cfg.hintr_worker_pools}
+    assert list(pools.keys()) == ["worker", "calibrate-worker"]
+    assert pools["worker"].workers == 5
+    assert pools["worker"].args == []
+    assert pools["calibrate-worker"].workers == 2
+    assert pools["calibrate-worker"].args == ["--calibrate-only"]
+    assert str(pools["worker"].ref) == "mrcide/hintr-worker:master"
+
+    options = {"hintr": {"worker_pools": {"fast": {
+        "workers": 3, "args": ["--queue=fast"], "tag": "mrc-123",
+        "resources": {"memory": "2g", "cpus": 0.5}}}}}
+    cfg = hint_deploy.HintConfig("config", options=options)
+    obj = hint_deploy.hint_constellation(cfg)
+    fast = obj.containers.find("fast")
+    assert fast.scale == 3
+    assert str(fast.image) == "mrcide/hintr-worker:mrc-123"
+    assert fast.kwargs["args"] == ["--queue=fast"]
+    assert fast.kwargs["environment"]["REDIS_URL"] == "redis://redis:6379"
+    pool = cfg.hintr_worker_pools[-1]
+    assert pool.memory == "2g"
+    assert pool.cpus == 0.5
+
+    container = mock.Mock()
+    pool.configure(container, cfg)
+    container.update.assert_called_once_with(
+        mem_limit="2g", memswap_limit="2g", cpu_period=100000,
+        cpu_quota=50000)
+
+
+def test_worker_pools_from_legacy_config():
+    dat = {"hintr": {"workers": 4, "calibrate-workers": 1}}
+    pools = hint_deploy.hintr_worker_pools(dat, "master")
+    assert [(x.name, x.workers, x.args) for x in pools] == \
+        [("worker", 4, []), ("calibrate-worker", 1, ["--calibrate-only"])]
+
+
+def test_worker_pool_names_must_not_clash():
+    for name, other in [("hintr", "hintr-api"), ("redis", "redis"),
+                        ("hint", "hint"), ("worker", "worker-fast")]:
+        dat = {"hintr": {"worker_pools": {name: {"workers": 1},
+                                          "worker-fast": {"workers": 1}}}}
+        with pytest.raises(ValueError, match="'{}' clashes with '{}'".format(
+                name, other)):
+            hint_deploy.hintr_worker_pools(dat, "master")
+    options = {"hintr": {"worker_pools": {"proxy": {"workers": 1}}}}
+    with pytest.raises(ValueError, match="'proxy' clashes with 'proxy'"):
+        hint_deploy.HintConfig("config", options=options)
+
+
+def test_worker_pool_resources_must_be_numeric():
+    dat = {"hintr": {"worker_pools": {"worker": {
+        "workers": 1, "resources": {"cpus": "lots"}}}}}
+    with pytest.raises(ValueError, match="Expected number for"):
+        hint_deploy.hintr_worker_pools(dat, "master")
+
+
+def test_scratch_mounts():
+    cfg = hint_deploy.HintConfig("config")
+    obj = hint_deploy.hint_constellation(cfg)
+    assert len(obj.containers.find("worker").kwargs["mounts"]) == 2
+    assert "TMPDIR" not in \
+        obj.containers.find("worker").kwargs["environment"]
+
+    options = {"hintr": {
+        "scratch": {"tmp": {"path": "/scratch", "size": "2g"}},
+        "worker_pools": {"worker": {"scratch": {"tmp": {
+            "path": "/fast", "type": "bind", "source": "/mnt/fast"}}}}}}
+    cfg = hint_deploy.HintConfig("config", options=options)
+    obj = hint_deploy.hint_constellation(cfg)
+    volumes = {"uploads": "hint_uploads", "results": "hint_results"}
+
+    api = obj.containers.find("hintr-api").kwargs
+    mounts = [x.to_mount(volumes) for x in api["mounts"]]
+    assert [x["Target"] for x in mounts] == \
+        ["/uploads", "/results", "/scratch"]
+    assert mounts[2]["Type"] == "tmpfs"
+    assert mounts[2]["TmpfsOptions"] == {"SizeBytes": 2 * 1024 ** 3}
+    assert api["environment"]["TMPDIR"] == "/scratch"
+
+    worker = obj.containers.find("worker").kwargs
+    mounts = [x.to_mount(volumes) for x in worker["mounts"]]
+    assert [x["Target"] for x in mounts] == ["/uploads", "/results", "/fast"]
+    assert mounts[2]["Type"] == "bind"
+    assert mounts[2]["Source"] == "/mnt/fast"
+    assert worker["environment"]["TMPDIR"] == "/fast"
+
+    calibrate = obj.containers.find("calibrate-worker").kwargs
+    assert calibrate["environment"]["TMPDIR"] == "/scratch"
+
+
+def test_scratch_type_is_validated():
+    dat = {"hintr": {"scratch": {"tmp": {"path": "/tmp", "type": "disk"}}}}
+    with pytest.raises(ValueError, match="Unknown scratch type 'disk'"):
+        hint_deploy.scratch_mounts(dat, ["hintr", "scratch"])
+
+
+def test_hint_candidate_is_probed_by_container_name():
+    cfg = hint_deploy.HintConfig("config")
+    obj = hint_deploy.hint_constellation(cfg)
+    loadbalancer = mock.Mock()
+    loadbalancer.exec_run.return_value = ExecResult(0, b"")
+    container = mock.Mock()
+    container.name = "hint-hint"
+    with mock.patch.object(obj.containers, "get", return_value=loadbalancer), \
+            mock.patch("constellation.ConstellationContainer") as candidate, \
+            mock.patch("src.hint_deploy.hint_configure") as configure:
+        candidate.return_value.get.return_value = container
+        hint_deploy.hint_candidate(obj, "hint", [8080])
+        responsive = configure.call_args[0][2]
+        assert responsive()
+    loadbalancer.exec_run.assert_called_once_with(
+        ["curl", "-sf", "-o", "/dev/null", "http://hint-hint:8080"])
+
+
+def test_hint_jvm_options():
+    cfg = hint_deploy.HintConfig("config")
+    obj = hint_deploy.hint_constellation(cfg)
+    assert cfg.hint_jvm_options == []
+    assert obj.containers.find("hint").environment is None
+
+    options = {"hint": {"jvm": {
+        "heap_min": "1g", "heap_max": "4g", "gc": "ZGC",
+        "cds_archive": "/tmp/hint.jsa", "cds_auto_create": True,
+        "options": ["-XX:TieredStopAtLevel=1"]}}}
+    cfg = hint_deploy.HintConfig("config", options=options)
+    obj = hint_deploy.hint_constellation(cfg)
+    assert cfg.hint_jvm_options == [
+        "-Xms1g", "-Xmx4g", "-XX:+UseZGC",
+        "-XX:SharedArchiveFile=/tmp/hint.jsa",
+        "-XX:+AutoCreateSharedArchive", "-XX:TieredStopAtLevel=1"]
+    assert obj.containers.find("hint").environment == {
+        "JAVA_TOOL_OPTIONS": " ".join(cfg.hint_jvm_options)}
+
+
+def test_hint_jvm_gc_is_validated():
+    dat = {"hint": {"jvm": {"gc": "CMS"}}}
+    with pytest.raises(ValueError):
+        hint_deploy.hint_jvm_options(dat, ["hint", "jvm"])
+
+
+def test_data_fix_rejects_unknown_script():
+    cfg = hint_deploy.HintConfig("config")
+    with pytest.raises(Exception, match="No data fix script 'missing'"):
+        hint_deploy.hint_data_fix(cfg, "missing.groovy", 500, 1, False)
+
+
+class FakeRedis:
+    def __init__(self, hashes):
+        self.hashes = hashes
+
+    def __call__(self, args):
+        if args[0] == "HGET":
+            return self.hashes.get(args[1], {}).get(args[2], "")
+        assert args[0] == "HGETALL"
+        values = self.hashes.get(args[1], {})
+        return "".join("{}\n{}\n".format(k, v) for k, v in values.items())
+
+
+class FakeWorker:
+    def __init__(self, name, statuses):
+        self.name = name
+        self.statuses = statuses
+        self.status = None
+        self.removed = False
+
+    def reload(self):
+        self.status = self.statuses.pop(0) if self.statuses else self.status
+
+    def remove(self, force=False):
+        self.removed = True
+
+
+def test_worker_queue_reports_busy_workers():
+    redis = FakeRedis({
+        "hintr:worker:status": {"w1": "IDLE", "w2": "BUSY", "w3": "BUSY"},
+        "hintr:worker:task": {"w2": "t2", "w3": "t3"}})
+    assert hint_deploy.WorkerQueue(redis, "hintr").busy() == \
+        {"w2": "t2", "w3": "t3"}
+    assert hint_deploy.WorkerQueue(redis, "other").busy() == {}
+    assert hint_deploy.WorkerQueue(redis, "hintr").busy(["w1", "w3"]) == \
+        {"w3": "t3"}
+
+
+def test_worker_drain_removes_drained_workers_first():
+    status = {"w1": "IDLE", "w2": "BUSY"}
+    redis = FakeRedis({"hintr:worker:status": status,
+                       "hintr:worker:task": {"w2": "fit-1"}})
+    idle = FakeWorker("hint-worker-1", ["exited"])
+    busy = FakeWorker("hint-calibrate-worker-1",
+                      ["running", "running", "running"])
+    queue = hint_deploy.WorkerQueue(redis, "hintr")
+    removed = []
+    original = queue.busy
+
+    def busy_jobs(ids):
+        removed.append([x.name for x in [idle, busy] if x.removed])
+        if len(removed) == 2:
+            status["w2"] = "IDLE"
+            # A replacement picking up a job is not waited on
+            status["w9"] = "BUSY"
+        return original(ids)
+    queue.busy = busy_jobs
+
+    f = io.StringIO()
+    with redirect_stdout(f):
+        hint_deploy.worker_drain(queue, [idle, busy], ["w1", "w2"], 60,
+                                 poll=0)
+    assert removed == [["hint-worker-1"], ["hint-worker-1"]]
+    assert busy.removed
+    assert f.getvalue().splitlines() == [
+        "[drain] Removing drained hint-worker-1",
+        "[drain] Waiting for 1 job(s) in flight (0s of 60s): w2 (fit-1)",
+        "[drain] Removing hint-calibrate-worker-1"]
+
+
+def test_worker_drain_gives_up_at_deadline():
+    redis = FakeRedis({"hintr:worker:status": {"w2": "BUSY"},
+                       "hintr:worker:task": {"w2": "fit-1"}})
+    busy = FakeWorker("hint-worker-1", ["running"])
+    f = io.StringIO()
+    with redirect_stdout(f):
+        hint_deploy.worker_drain(hint_deploy.WorkerQueue(redis, "hintr"),
+                                 [busy], ["w2"], 0, poll=0)
+    assert busy.removed
+    assert "interrupting 1 job(s): w2 (fit-1)" in f.getvalue()
+
+
+def test_stop_tiers_in_dependency_order():
+    options = {"deploy": {"stop_timeouts": {"data": 120}}}
+    cfg = hint_deploy.HintConfig("config", options=options)
+    assert cfg.stop_timeouts == {"front": 10, "hintr": 10, "data": 120}
+    obj = hint_deploy.hint_constellation(cfg)
+    stopped = []
+
+    def fake(name, status="running"):
+        container = mock.Mock(status=status)
+        container.stop.side_effect = \
+            lambda timeout: stopped.append((name, timeout))
+        return container
+
+    def get_container(self, prefix):
+        return fake(self.name)
+
+    def get_service(self, prefix, stopped=False):
+        return [fake(self.name), fake(self.name, "exited")]
+
+    with mock.patch.object(constellation.ConstellationContainer, "get",
+                           get_container):
+        with mock.patch.object(constellation.ConstellationService, "get",
+                               get_service):
+            f = io.StringIO()
+            with redirect_stdout(f):
+                hint_deploy.hint_stop_tiers(obj)
+
+    tiers = [set(x[0] for x in stopped[:2]), set(x[0] for x in stopped[2:6]),
+             set(x[0] for x in stopped[6:])]
+    assert tiers == [{"proxy", "hint"},
+                     {"hintr", "hintr-api", "worker", "calibrate-worker"},
+                     {"db", "redis"}]
+    assert [x[1] for x in stopped] == [10] * 6 + [120] * 2
+    out = f.getvalue()
+    assert out.count("Removing 'worker'") == 2
+    assert "[stop] Stopped hintr tier (7 containers)" in out
+
+
+def test_scale_rejects_unknown_pool():
+    cfg = hint_deploy.HintConfig("config")
+    obj = hint_deploy.hint_constellation(cfg)
+    with pytest.raises(Exception, match="'hint' is not a worker pool"):
+        hint_deploy.hint_scale(obj, "hint", 2)
+
+
+def fake_replica(name, hostname):
+    container = mock.Mock(attrs={"Config": {"Hostname": hostname}})
+    container.name = name
+    return container
+
+
+def test_scale_down_prefers_idle_workers():
+    status = {"w1": "BUSY", "w2": "IDLE", "w3": "BUSY"}
+    redis = FakeRedis({
+        "hintr:worker:status": status,
+        "hintr:worker:task": {"w1": "fit-1", "w3": "fit-3"},
+        "hintr:worker:info": {"w1": "X\nabc111\x00", "w2": "X\nabc222",
+                              "w3": "X\nabc333"}})
+    queue = hint_deploy.WorkerQueue(redis, "hintr")
+    containers = [fake_replica("hint-worker-a", "abc111"),
+                  fake_replica("hint-worker-b", "abc222"),
+                  fake_replica("hint-worker-c", "abc333")]
+    res = hint_deploy.worker_scale_down(queue, containers, 1, 60, poll=0)
+    assert [x.name for x in res] == ["hint-worker-b"]
+
+    original = queue.busy
+
+    def busy():
+        # w3 finishes its job while we wait
+        if busy.calls:
+            status["w3"] = "IDLE"
+        busy.calls += 1
+        return original()
+    busy.calls = 0
+    queue.busy = busy
+    f = io.StringIO()
+    with redirect_stdout(f):
+        res = hint_deploy.worker_scale_down(queue, containers, 2, 60,
+                                            poll=0)
+    assert [x.name for x in res] == ["hint-worker-b", "hint-worker-c"]
+    assert "1 of 2 workers to remove are idle" in f.getvalue()
+    assert "fit-1" in f.getvalue()
+
+
+def test_scale_down_interrupts_at_deadline():
+    redis = FakeRedis({
+        "hintr:worker:status": {"w1": "BUSY"},
+        "hintr:worker:task": {"w1": "fit-1"},
+        "hintr:worker:info": {"w1": "abc111"}})
+    queue = hint_deploy.WorkerQueue(redis, "hintr")
+    containers = [fake_replica("hint-worker-a", "abc111")]
+    f = io.StringIO()
+    with redirect_stdout(f):
+        res = hint_deploy.worker_scale_down(queue, containers, 1, 0, poll=0)
+    assert res == containers
+    assert "interrupting: w1 (fit-1)" in f.getvalue()
+
+
+def test_hint_switch_reloads_proxy_around_retiring_old():
+    cfg = hint_deploy.HintConfig("config")
+    obj = hint_deploy.hint_constellation(cfg)
+    proxy = mock.Mock()
+    proxy.exec_run.return_value = (0, b"")
+    old = mock.Mock(status="running")
+    old.name = "hint-hint"
+    new = mock.Mock()
+    new.name = "hint-hint-abc"
+    calls = mock.Mock()
+    calls.attach_mock(proxy.exec_run, "proxy")
+    calls.attach_mock(old.stop, "stop")
+    with mock.patch("src.hint_deploy.docker") as docker, \
+            mock.patch.object(obj.containers, "get", return_value=proxy), \
+            mock.patch("src.hint_deploy.docker_util.container_remove_wait"):
+        hint_deploy.hint_switch(obj, old, new, "hint-abc")
+        network = docker.client.from_env.return_value.networks.get
+        network.assert_called_once_with("hint_nw")
+        network.return_value.connect.assert_called_once_with(
+            new, aliases=["hint", "hint-abc"])
+
+    assert [x[0] for x in calls.mock_calls] == \
+        ["proxy", "proxy", "stop", "proxy", "proxy"]
+    assert calls.mock_calls[1][1][0] == ["nginx", "-s", "reload"]
+
+
+def mock_db(fingerprint, state="12:12"):
+    def exec_run(args):
+        sql = args[-1]
+        if sql == hint_deploy.DB_SCHEMA_FINGERPRINT_SQL:
+            return (0, fingerprint.encode("UTF-8"))
+        elif sql == hint_deploy.DB_SCHEMA_STATE_SQL:
+            return (0, (state + "\n").encode("UTF-8"))
+        return (0, b"COMMENT\n")
+    db = mock.Mock()
+    db.name = "hint-db"
+    db.exec_run.side_effect = exec_run
+    db.client.images.get.return_value.id = "sha256:abc"
+    return db
+
+
+def test_migrations_skipped_if_schema_current():
+    cfg = hint_deploy.HintConfig("config")
+    db = mock_db("sha256:abc 12:12")
+    hint_deploy.db_migrate_start(db, cfg)
+    assert not db.client.containers.run.called
+
+
+def test_migrations_run_if_image_or_history_changed():
+    cfg = hint_deploy.HintConfig("config")
+    for db in [mock_db("sha256:old 12:12"),
+               mock_db("sha256:abc 11:11"),
+               mock_db("")]:
+        hint_deploy.db_migrate_start(db, cfg)
+        db.client.containers.run.assert_called_once_with(
+            "mrcide/hint-db-migrate:master",
+            ["-url=jdbc:postgresql://hint-db/hint"],
+            name="hint-db-migrate", network="hint_nw", detach=True)
+
+
+def test_migration_wait_records_fingerprint():
+    cfg = hint_deploy.HintConfig("config")
+    db = mock_db("", "13:13")
+    client = mock.Mock()
+    migrate = client.containers.get.return_value
+    migrate.wait.return_value = {"StatusCode": 0}
+    migrate.image.id = "sha256:new"
+    with mock.patch.object(client.containers, "get",
+                           side_effect=[migrate, db]):
+        hint_deploy.db_migrate_wait(client, cfg)
+    assert migrate.remove.called
+    assert db.exec_run.call_args[0][0][-1] == \
+        "COMMENT ON TABLE flyway_schema_history IS 'sha256:new 13:13'"
+
+    migrate.wait.return_value = {"StatusCode": 1}
+    migrate.logs.return_value = b"flyway error"
+    with mock.patch.object(client.containers, "get",
+                           side_effect=[migrate, db]):
+        with pytest.raises(Exception, match="Database migration failed"):
+            hint_deploy.db_migrate_wait(client, cfg)
+
+
+def test_redis_persistence_settings():
+    cfg = hint_deploy.HintConfig("config")
+    assert hint_deploy.redis_persistence_settings(cfg) == {
+        "appendfsync": "everysec",
+        "aof-use-rdb-preamble": "yes",
+        "maxmemory-policy": "noeviction"}
+    options = {"redis": {"persistence": {"appendfsync": "always",
+                                         "aof_use_rdb_preamble": False,
+                                         "maxmemory": "2gb"}}}
+    cfg = hint_deploy.HintConfig("config", options=options)
+    assert hint_deploy.redis_persistence_settings(cfg) == {
+        "appendfsync": "always",
+        "aof-use-rdb-preamble": "no",
+        "maxmemory-policy": "noeviction",
+        "maxmemory": "2gb"}
+    options = {"redis": {"persistence": {"appendfsync": "sometimes"}}}
+    with pytest.raises(ValueError, match="Expected one of"):
+        hint_deploy.HintConfig("config", options=options)
+
+
+def test_redis_cache_is_optional():
+    cfg = hint_deploy.HintConfig("config")
+    obj = hint_deploy.hint_constellation(cfg)
+    assert "redis-cache" not in [x.name for x in obj.containers.collection]
+    assert "REDIS_CACHE_URL" not in \
+        obj.containers.find("hintr-api").kwargs["environment"]
+    assert [x["name"] for x in hint_deploy.redis_instances(cfg)] == ["redis"]
+
+    options = {"redis": {"cache": {"enabled": True, "maxmemory": "2gb"}}}
+    cfg = hint_deploy.HintConfig("config", options=options)
+    obj = hint_deploy.hint_constellation(cfg)
+    cache = obj.containers.find("redis-cache")
+    assert cache.mounts == []
+    assert cache.args == ["--appendonly", "no", "--save", "",
+                          "--maxmemory", "2gb",
+                          "--maxmemory-policy", "allkeys-lru"]
+    assert cache.configure == hint_deploy.redis_cache_configure
+    for name in ["hintr-api", "worker", "calibrate-worker"]:
+        env = obj.containers.find(name).kwargs["environment"]
+        assert env["REDIS_URL"] == "redis://redis:6379"
+        assert env["REDIS_CACHE_URL"] == "redis://redis-cache:6379"
+    assert [(x["name"], x["durable"])
+            for x in hint_deploy.redis_instances(cfg)] == \
+        [("redis", True), ("redis-cache", False)]
+
+
+def mock_redis(*infos):
+    container = mock.Mock(status="running")
+    outputs = iter(infos)
+
+    def exec_run(args, **kwargs):
+        if args[1] == "INFO":
+            info = "# Persistence\r\n" + "".join(
+                "{}:{}\r\n".format(k, v) for k, v in next(outputs).items())
+            return ExecResult(0, info.encode("UTF-8"))
+        return ExecResult(0, b"Background append only file rewriting started")
+    container.exec_run.side_effect = exec_run
+    return container
+
+
+def test_redis_compact_waits_for_rewrite():
+    cfg = hint_deploy.HintConfig("config")
+    obj = hint_deploy.hint_constellation(cfg)
+    aof = {"aof_enabled": 1, "aof_rewrite_scheduled": 0,
+           "aof_current_size": 2500000}
+    container = mock_redis(aof, dict(aof, aof_rewrite_in_progress=1),
+                           dict(aof, aof_rewrite_in_progress=0), aof)
+    f = io.StringIO()
+    with mock.patch.object(obj.containers, "get", return_value=container):
+        with redirect_stdout(f):
+            hint_deploy.redis_compact(obj)
+    commands = [x[0][0][1] for x in container.exec_run.call_args_list]
+    assert commands == ["INFO", "BGREWRITEAOF", "INFO", "INFO", "INFO"]
+    assert "[redis] Rewriting AOF before stopping" in f.getvalue()
+    assert "(AOF 2.5 MB)" in f.getvalue()
+
+    container = mock_redis({"aof_enabled": 0},
+                           {"rdb_bgsave_in_progress": 0},
+                           {"aof_enabled": 0})
+    with mock.patch.object(obj.containers, "get", return_value=container):
+        hint_deploy.redis_compact(obj)
+    commands = [x[0][0][1] for x in container.exec_run.call_args_list]
+    assert commands == ["INFO", "BGSAVE", "INFO", "INFO"]
@@ -0,0 +1,69 @@
+import datetime
+import docker
+import json
+
+from types import SimpleNamespace
+from unittest import mock
+
+from src import hint_docker
+
+
+def response(method, path, body=None, length=None, seconds=0.5):
+    headers = {"Content-Length": str(length)} if length is not None else {}
+    request = SimpleNamespace(method=method, path_url=path, body=body)
+    return SimpleNamespace(request=request, headers=headers,
+                           elapsed=datetime.timedelta(seconds=seconds))
+
+
+def test_api_endpoint_normalises_ids():
+    f = hint_docker.api_endpoint
+    assert f("/v1.45/containers/json?all=1") == "/containers/json"
+    assert f("/v1.45/containers/abc123/json") == "/containers/{id}/json"
+    assert f("/v1.45/containers/hint-db/exec") == "/containers/{id}/exec"
+    assert f("/v1.45/exec/abc/start") == "/exec/{id}/start"
+    assert f("/v1.45/containers/create?name=hint-db") == "/containers/create"
+    assert f("/v1.45/images/mrcide/hint:master/json") == \
+        "/images/{name}/json"
+    assert f("/v1.45/images/create?fromImage=redis") == "/images/create"
+    assert f("/v1.45/networks/hint_nw/connect") == "/networks/{id}/connect"
+    assert f("/v1.45/volumes/hint_uploads") == "/volumes/{id}"
+    assert f("/version") == "/version"
+
+
+def test_stats_accumulate_per_endpoint():
+    stats = hint_docker.DockerStats()
+    stats.record(response("GET", "/v1.45/containers/a/json", length=100))
+    stats.record(response("GET", "/v1.45/containers/b/json", length=50))
+    stats.record(response("POST", "/v1.45/containers/a/exec", b"{}", 0, 1))
+    stats.record(response("GET", "/v1.45/containers/a/logs", seconds=0))
+    assert stats.endpoints["GET /containers/{id}/json"] == \
+        {"calls": 2, "seconds": 1.0, "bytes_sent": 0, "bytes_received": 150}
+    assert stats.endpoints["POST /containers/{id}/exec"]["bytes_sent"] == 2
+    assert stats.total() == {"calls": 4, "seconds": 2.0, "bytes_sent": 2,
+                             "bytes_received": 150}
+
+
+def test_session_shares_one_instrumented_client(tmp_path, monkeypatch):
+    dest = str(tmp_path / "stats.json")
+    monkeypatch.setenv(hint_docker.STATS_ENV, dest)
+    from_env = docker.client.from_env
+    from_env_top = docker.from_env
+    with mock.patch("docker.client.from_env") as original:
+        original.side_effect = lambda **kwargs: mock.MagicMock()
+        with hint_docker.docker_session() as stats:
+            client = docker.client.from_env()
+            assert docker.client.from_env() is client
+            assert docker.from_env() is client
+            assert original.call_count == 1
+            assert original.call_args == mock.call(max_pool_size=32)
+            client.api.hooks["response"].append.assert_called_once_with(
+                stats.record)
+            stats.record(response("GET", "/v1.45/version", length=10))
+        assert docker.client.from_env is original
+        client.close.assert_called_once()
+    assert docker.client.from_env is from_env
+    assert docker.from_env is from_env_top
+    with open(dest) as f:
+        dat = json.load(f)
+    assert dat["total"]["calls"] == 1
+    assert list(dat["endpoints"].keys()) == ["GET /version"]
@@ -0,0 +1,103 @@
+import io
+import sqlite3
+
+from contextlib import redirect_stdout
+from unittest import mock
+
+from src import hint_deploy, hint_history
+
+
+def deploy(action, duration, outcome="success"):
+    return {"action": action, "duration": duration, "outcome": outcome}
+
+
+def test_history_regressions():
+    rows = [deploy("start", 100), deploy("start", 120),
+            deploy("start", 500, "failure"), deploy("upgrade_all", 300),
+            deploy("start", 140), deploy("start", 111)]
+    res = hint_history.history_regressions(rows, 25)
+    assert [x["median"] for x in res] == [None, 100, 110, None, 110, 120]
+    assert [x["regression"] for x in res] == \
+        [False, False, True, False, True, False]
+
+
+def test_history_regressions_uses_window():
+    rows = [deploy("start", 1000)] + [deploy("start", 10)] * 3
+    res = hint_history.history_regressions(rows + [deploy("start", 20)],
+                                           50, window=3)
+    assert res[-1]["median"] == 10
+    assert res[-1]["regression"]
+
+
+@mock.patch('src.hint_history.running_images',
+            return_value={"mrcide/hint:master": "sha256:abc"})
+def test_history_round_trip(running_images, tmp_path):
+    path = str(tmp_path)
+    cfg = hint_deploy.HintConfig("config")
+    record = hint_history.DeployRecord("start", "staging", cfg)
+    with record.phase("pull"):
+        pass
+    record.fail(Exception("some error"))
+    hint_history.history_append(path, record)
+
+    rows = hint_history.history_read(path)
+    assert len(rows) == 1
+    assert rows[0]["action"] == "start"
+    assert rows[0]["config_name"] == "staging"
+    assert rows[0]["outcome"] == "failure"
+    assert rows[0]["error"] == "some error"
+    assert rows[0]["tags"]["hint"] == cfg.hint_tag
+    assert rows[0]["digests"] == {"mrcide/hint:master": "sha256:abc"}
+    assert list(rows[0]["phases"].keys()) == ["pull"]
+
+    f = io.StringIO()
+    with redirect_stdout(f):
+        hint_history.history_report(path, 20, 25)
+    out = f.getvalue()
+    assert "Deploy history (1 most recent)" in out
+    assert "failure" in out
+    assert "pull 0s" in out
+
+
+def test_history_report_empty(tmp_path):
+    f = io.StringIO()
+    with redirect_stdout(f):
+        hint_history.history_report(str(tmp_path), 20, 25)
+    assert f.getvalue() == "No deploys recorded\n"
+
+
+def test_phase_is_noop_without_record():
+    with hint_history.phase(None, "pull"):
+        pass
+
+
+@mock.patch('src.hint_history.running_images', return_value={})
+def test_history_records_hint_responsive_time(running_images, tmp_path):
+    path = str(tmp_path)
+    options = {"hint": {"jvm": {"heap_max": "4g"}}}
+    cfg = hint_deploy.HintConfig("config", options=options)
+    record = hint_history.DeployRecord("start", None, cfg)
+    cfg.hint_responsive_seconds = 12.5
+    hint_history.history_append(path, record)
+
+    rows = hint_history.history_read(path)
+    assert rows[0]["metrics"] == {"hint_responsive": 12.5}
+    assert rows[0]["tags"]["hint-jvm"] == "-Xmx4g"
+
+    f = io.StringIO()
+    with redirect_stdout(f):
+        hint_history.history_report(path, 20, 25)
+    assert "hint responsive after 12.5s  (jvm: -Xmx4g)" in f.getvalue()
+
+
+@mock.patch('src.hint_history.running_images', return_value={})
+def test_history_adds_metrics_to_old_database(running_images, tmp_path):
+    path = str(tmp_path)
+    con = sqlite3.connect(hint_history.path_history(path))
+    con.execute(hint_history.HISTORY_SCHEMA.replace(
+        "metrics TEXT NOT NULL DEFAULT '{}',", ""))
+    con.close()
+    cfg = hint_deploy.HintConfig("config")
+    hint_history.history_append(
+        path, hint_history.DeployRecord("stop", None, cfg))
+    assert hint_history.history_read(path)[0]["metrics"] == {}
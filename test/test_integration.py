@@ -3,6 +3,7 @@ import json
 import io
 import os.path
 import pytest
+import re
 import requests
 import time
 import logging
@@ -24,6 +25,7 @@ logging.basicConfig(level=logging.DEBUG)
 s = requests.Session()
 retries = Retry(total=10, backoff_factor=1, status_forcelist=[502, 503, 504])
 s.mount('http://', HTTPAdapter(max_retries=retries))
+s.mount('https://', HTTPAdapter(max_retries=retries))
 
 
 def test_start_hint():
@@ -112,6 +114,31 @@ def test_start_hint():
         "hint-calibrate-worker-", False)) == 0
 
 
+def test_start_hint_with_pgbouncer():
+    options = {"pgbouncer": {"enabled": True}}
+    cfg = hint_deploy.HintConfig("config", options=options)
+    obj = hint_deploy.hint_constellation(cfg)
+    obj.start()
+    assert docker_util.container_exists("hint-pgbouncer")
+
+    user = "test@example.com"
+    with redirect_stdout(io.StringIO()):
+        hint_deploy.hint_user(cfg, "add-user", user, True, "password")
+
+    # Logging in goes through pgbouncer, while the user was added
+    # directly against the db
+    res = s.get("http://localhost:8080/login")
+    assert res.status_code == 200
+    action = re.search(r'<form[^>]*action="([^"]+)"',
+                       res.content.decode("UTF-8")).group(1)
+    res = s.post(requests.compat.urljoin(res.url, action),
+                 data={"username": user, "password": "password"})
+    assert res.status_code == 200
+    assert "/login" not in res.url
+
+    obj.destroy()
+
+
 def test_start_hint_from_cli():
     if os.path.exists("config/.last_deploy"):
         os.remove("config/.last_deploy")
@@ -165,6 +192,29 @@ def test_configure_proxy():
     container.kill()
 
 
+def test_proxy_performance_headers():
+    options = {"proxy": {"performance": {"gzip_level": 5,
+                                         "static_max_age": 3600}}}
+    cfg = hint_deploy.HintConfig("config", options=options)
+    obj = hint_deploy.hint_constellation(cfg)
+    obj.start()
+
+    headers = {"Accept-Encoding": "gzip"}
+    res = s.get("https://localhost", headers=headers, verify=False)
+    assert res.status_code == 200
+    assert res.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in res.headers["Vary"]
+    assert "Cache-Control" not in res.headers
+
+    bundle = re.search(r'src="([^"]+\.js)"', res.text).group(1)
+    res = s.get("https://localhost" + bundle, headers=headers, verify=False)
+    assert res.status_code == 200
+    assert res.headers["Content-Encoding"] == "gzip"
+    assert res.headers["Cache-Control"] == "public, max-age=3600"
+
+    obj.destroy()
+
+
 def test_update_hintr_and_all():
     hint_cli.main(["start"])
 
@@ -178,6 +228,7 @@ def test_update_hintr_and_all():
     assert "Pulling docker image db-migrate" not in p
     assert "Killing hint-hintr" in p
     assert "Stopping hint-hintr-api-" in p
+    assert "[drain] Removing" in p
     assert "Starting hintr" in p
     assert "Starting *service* hintr-api" in p
     assert "Starting *service* calibrate-worker" in p
@@ -195,11 +246,12 @@ def test_update_hintr_and_all():
     assert len(docker_util.containers_matching("hint-hintr-api-", False)) == 1
     assert len(docker_util.containers_matching("hint-hintr-api-", True)) == 1
     assert len(docker_util.containers_matching("hint-worker-", False)) == 2
-    assert len(docker_util.containers_matching("hint-worker-", True)) == 4
+    # Drained workers are removed rather than left behind stopped
+    assert len(docker_util.containers_matching("hint-worker-", True)) == 2
     assert len(docker_util.containers_matching(
         "hint-calibrate-worker", False)) == 1
     assert len(docker_util.containers_matching(
-        "hint-calibrate-worker", True)) == 2
+        "hint-calibrate-worker", True)) == 1
 
     # Can access hintr endpoints
     res = s.get("http://localhost:8888")
@@ -221,10 +273,13 @@ def test_update_hintr_and_all():
     p = f.getvalue()
     assert "Pulling docker image db" in p
     assert "Pulling docker image db-migrate" in p
+    assert "[db] Schema is up to date with mrcide/hint-db-migrate" in p
+    assert "[redis] Rewriting AOF before stopping" in p
     assert "Stop 'redis'" in p
     assert "Removing 'redis'" in p
     assert "Starting redis" in p
     assert "[redis] Waiting for redis to come up" in p
+    assert "[redis] Loaded data in" in p
     assert "[hintr] Configuring loadbalancer" in p
 
     assert docker_util.network_exists("hint_nw")
@@ -253,6 +308,51 @@ def test_update_hintr_and_all():
     obj.destroy()
 
 
+def test_scale_worker_pool():
+    cfg = hint_deploy.HintConfig("config")
+    obj = hint_deploy.hint_constellation(cfg)
+    obj.start()
+
+    hint_deploy.hint_scale(obj, "worker", 4)
+    assert len(docker_util.containers_matching("hint-worker-", False)) == 4
+    hint_deploy.hint_scale(obj, "worker", 1)
+    assert len(docker_util.containers_matching("hint-worker-", True)) == 1
+    assert len(docker_util.containers_matching(
+        "hint-calibrate-worker-", False)) == 1
+
+    obj.destroy()
+
+
+def test_upgrade_all_blue_green_keeps_db_and_redis():
+    hint_cli.main(["start"])
+    cfg = hint_deploy.HintConfig("config")
+    obj = hint_deploy.hint_constellation(cfg)
+    db = obj.containers.get("db", obj.prefix)
+    redis = obj.containers.get("redis", obj.prefix)
+    hint = obj.containers.get("hint", obj.prefix)
+
+    f = io.StringIO()
+    with redirect_stdout(f):
+        hint_cli.main(["upgrade", "--blue-green", "all"])
+    p = f.getvalue()
+    assert "[db] Schema is up to date with mrcide/hint-db-migrate" in p
+    assert "[hint] Switching proxy from hint-hint to hint-hint-" in p
+    assert "Stop 'redis'" not in p
+
+    assert obj.containers.get("db", obj.prefix).id == db.id
+    assert obj.containers.get("redis", obj.prefix).id == redis.id
+    assert obj.containers.get("hint", obj.prefix).id != hint.id
+    assert len(docker_util.containers_matching("hint-hint-", True)) == 0
+
+    res = s.get("http://localhost:8080")
+    assert res.status_code == 200
+    res = s.get("https://localhost", verify=False)
+    assert res.status_code == 200
+    assert "Naomi" in res.content.decode("UTF-8")
+
+    obj.destroy()
+
+
 def test_start_pulls_db_migrate():
     cfg = hint_deploy.HintConfig("config")
     obj = hint_deploy.hint_constellation(cfg)
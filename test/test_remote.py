@@ -0,0 +1,255 @@
+import io
+import pytest
+
+from contextlib import redirect_stdout
+from unittest import mock
+
+import docker
+
+from src import hint_deploy
+
+
+class FakeContainer:
+    def __init__(self, client, name, **kwargs):
+        self.client = client
+        self.name = name
+        self.kwargs = kwargs
+        self.status = "running"
+        self.calls = []
+
+    def exec_run(self, args):
+        self.calls.append(args)
+
+    def stop(self):
+        self.status = "exited"
+
+    def kill(self):
+        self.status = "exited"
+
+    def remove(self, force=False):
+        del self.client.containers.items[self.name]
+
+    def update(self, **kwargs):
+        self.calls.append(kwargs)
+
+
+class FakeContainers:
+    def __init__(self, client):
+        self.client = client
+        self.items = {}
+
+    def run(self, image, args, name, **kwargs):
+        container = FakeContainer(self.client, name, image=image, args=args,
+                                  **kwargs)
+        self.items[name] = container
+        return container
+
+    def list(self, all=False, filters=None):
+        return [v for k, v in self.items.items()
+                if k.startswith(filters["name"])]
+
+
+class FakeImages:
+    def __init__(self):
+        self.pulled = []
+
+    def get(self, ref):
+        if ref not in self.pulled:
+            raise docker.errors.ImageNotFound(ref)
+
+    def pull(self, ref):
+        self.pulled.append(ref)
+
+
+class FakeNamed:
+    def __init__(self, name, **kwargs):
+        self.name = name
+        self.kwargs = kwargs
+
+
+class FakeCollection:
+    def __init__(self):
+        self.items = []
+
+    def list(self, names=None):
+        return [x for x in self.items if names is None or x.name in names]
+
+    def create(self, name, **kwargs):
+        self.items.append(FakeNamed(name, **kwargs))
+
+
+class FakeClient:
+    def __init__(self):
+        self.containers = FakeContainers(self)
+        self.images = FakeImages()
+        self.networks = FakeCollection()
+        self.volumes = FakeCollection()
+
+
+class UnreachableContainers:
+    def list(self, **kwargs):
+        raise docker.errors.DockerException("connection refused")
+
+
+NFS = {"type": "nfs", "o": "addr=naomi,rw", "device": ":/srv/uploads"}
+
+
+def remote_config(**pool):
+    pool = dict({"workers": 1, "placement": {"fit1": 2, "fit2": 1}}, **pool)
+    options = {
+        "docker": {"endpoints": {
+            "fit1": {"base_url": "tcp://fit1:2376", "tls": True,
+                     "volumes": {"uploads": NFS, "results": NFS}},
+            "fit2": {"base_url": "ssh://hint@fit2",
+                     "volumes": {"uploads": NFS, "results": NFS}}}},
+        "redis": {"port": 6379, "host": "naomi.example.com",
+                  "bind": "10.0.0.5", "password": "s3cret/pw"},
+        "hintr": {"worker_pools": {"worker": pool}}}
+    return hint_deploy.HintConfig("config", options=options)
+
+
+def test_placement_is_validated():
+    options = {"redis": {"port": 6379, "host": "naomi"},
+               "hintr": {"worker_pools": {"worker": {
+                   "workers": 1, "placement": {"fit1": 2}}}}}
+    with pytest.raises(ValueError, match="unknown endpoint 'fit1'"):
+        hint_deploy.HintConfig("config", options=options)
+
+    options["docker"] = {"endpoints": {"fit1": {
+        "base_url": "tcp://fit1", "volumes": {"uploads": NFS}}}}
+    with pytest.raises(ValueError,
+                       match="Endpoint 'fit1' needs volume options for "
+                       "results"):
+        hint_deploy.HintConfig("config", options=options)
+
+    options["docker"]["endpoints"]["fit1"]["volumes"]["results"] = NFS
+    options["redis"] = {}
+    with pytest.raises(ValueError, match="need redis:port and redis:host"):
+        hint_deploy.HintConfig("config", options=options)
+
+    options["redis"] = {"port": 6379, "host": "naomi"}
+    with pytest.raises(ValueError, match="need redis:bind and redis:password"):
+        hint_deploy.HintConfig("config", options=options)
+
+    options["redis"] = {"port": 6379, "host": "naomi", "bind": "10.0.0.5"}
+    with pytest.raises(ValueError, match="need redis:bind and redis:password"):
+        hint_deploy.HintConfig("config", options=options)
+
+    options["redis"] = {"port": 6379, "host": "naomi", "bind": "10.0.0.5",
+                        "password": "pw", "cache": {"enabled": True}}
+    with pytest.raises(ValueError, match="need redis:cache:port"):
+        hint_deploy.HintConfig("config", options=options)
+
+
+def test_redis_port_is_published_for_remote_workers():
+    cfg = hint_deploy.HintConfig("config")
+    obj = hint_deploy.hint_constellation(cfg)
+    assert not obj.containers.find("redis").ports
+    assert hint_deploy.hint_remote_workers(cfg) == []
+
+    cfg = remote_config()
+    obj = hint_deploy.hint_constellation(cfg)
+    redis = obj.containers.find("redis")
+    assert redis.ports == {"6379/tcp": ("10.0.0.5", 6379)}
+    assert redis.args[-2:] == ["--requirepass", "s3cret/pw"]
+    assert redis.environment == {"REDISCLI_AUTH": "s3cret/pw"}
+    assert obj.containers.find("worker").scale == 1
+    hintr = obj.containers.find("hintr-api")
+    assert hintr.kwargs["environment"]["REDIS_URL"] == \
+        "redis://:s3cret%2Fpw@redis:6379"
+
+    # Without a bind address a published port stays on loopback
+    options = {"redis": {"port": 6379}}
+    cfg = hint_deploy.HintConfig("config", options=options)
+    obj = hint_deploy.hint_constellation(cfg)
+    assert obj.containers.find("redis").ports == \
+        {"6379/tcp": ("127.0.0.1", 6379)}
+
+
+def test_redis_cache_is_published_like_redis():
+    cfg = remote_config()
+    cfg.redis_cache_enabled = True
+    cfg.redis_cache_port = 6380
+    obj = hint_deploy.hint_constellation(cfg)
+    cache = obj.containers.find("redis-cache")
+    assert cache.ports == {"6379/tcp": ("10.0.0.5", 6380)}
+    assert cache.args[-2:] == ["--requirepass", "s3cret/pw"]
+    assert cache.environment == {"REDISCLI_AUTH": "s3cret/pw"}
+    hintr = obj.containers.find("hintr-api")
+    assert hintr.kwargs["environment"]["REDIS_CACHE_URL"] == \
+        "redis://:s3cret%2Fpw@redis-cache:6379"
+
+    remote = hint_deploy.hint_remote_workers(cfg, {"fit1": FakeClient(),
+                                                   "fit2": FakeClient()})
+    remote[0].start(False)
+    container = list(remote[0].client.containers.items.values())[0]
+    assert container.kwargs["environment"]["REDIS_CACHE_URL"] == \
+        "redis://:s3cret%2Fpw@naomi.example.com:6380"
+
+
+def test_redis_password_is_read_from_the_vault():
+    cfg = remote_config()
+    client = mock.MagicMock()
+    client.read.return_value = {"data": {"password": "pw"}}
+    with mock.patch.object(cfg.vault, "client", return_value=client):
+        hint_deploy.redis_resolve_password(cfg)
+        assert cfg.redis_password == "s3cret/pw"
+        assert not client.read.called
+
+        cfg.redis_password = "VAULT:secret/hint/redis:password"
+        hint_deploy.redis_resolve_password(cfg)
+    assert cfg.redis_password == "pw"
+    client.read.assert_called_once_with("secret/hint/redis")
+
+
+def test_remote_workers_start_on_each_endpoint():
+    cfg = remote_config(resources={"memory": "2g"})
+    clients = {"fit1": FakeClient(), "fit2": FakeClient()}
+    remote = hint_deploy.hint_remote_workers(cfg, clients)
+    assert [(x.endpoint.name, x.count) for x in remote] == \
+        [("fit1", 2), ("fit2", 1)]
+    for x in remote:
+        x.start(False)
+
+    fit1 = clients["fit1"]
+    names = sorted(fit1.containers.items.keys())
+    assert len(names) == 2
+    assert all(x.startswith("hint-worker-fit1-") for x in names)
+    assert [x.name for x in remote[1].containers()] == \
+        list(clients["fit2"].containers.items.keys())
+    assert fit1.images.pulled == ["mrcide/hintr-worker:master"]
+    assert [x.name for x in fit1.networks.items] == ["hint_nw"]
+    volumes = {x.name: x.kwargs["driver_opts"] for x in fit1.volumes.items}
+    assert volumes == {"hint_uploads": NFS, "hint_results": NFS}
+
+    container = fit1.containers.items[names[0]]
+    env = container.kwargs["environment"]
+    assert env["REDIS_URL"] == "redis://:s3cret%2Fpw@naomi.example.com:6379"
+    assert [(x["Target"], x["Source"]) for x in container.kwargs["mounts"]] \
+        == [("/uploads", "hint_uploads"), ("/results", "hint_results")]
+    assert container.calls == [{"mem_limit": "2g", "memswap_limit": "2g"}]
+
+
+def test_remote_workers_stop_and_status():
+    cfg = remote_config()
+    clients = {"fit1": FakeClient(), "fit2": FakeClient()}
+    remote = hint_deploy.hint_remote_workers(cfg, clients)
+    for x in remote:
+        x.start(False)
+    running, stopped = sorted(remote[0].containers(), key=lambda x: x.name)
+    stopped.status = "exited"
+    clients["fit2"].containers = UnreachableContainers()
+
+    f = io.StringIO()
+    with redirect_stdout(f):
+        for x in remote:
+            x.status()
+    assert f.getvalue().splitlines() == [
+        "    {} (fit1): running".format(running.name),
+        "    {} (fit1): exited".format(stopped.name),
+        "    fit2: unreachable (connection refused)"]
+
+    remote[0].stop()
+    assert clients["fit1"].containers.items == {}
+    assert running.calls == [["hintr_stop"]]
+    assert stopped.calls == []
@@ -0,0 +1,190 @@
+import http.server
+import pytest
+import threading
+
+from types import SimpleNamespace
+from unittest import mock
+
+import docker
+
+from src import hint_deploy, hint_upgrade_gate
+
+
+class MockHandler(http.server.BaseHTTPRequestHandler):
+    status = 200
+
+    def do_GET(self):
+        self.send_response(self.server.status)
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def endpoint():
+    server = http.server.HTTPServer(("localhost", 0), MockHandler)
+    server.status = 200
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class FakeImage:
+    def __init__(self, images, image_id):
+        self.images = images
+        self.id = image_id
+
+    def tag(self, repository, tag):
+        self.images.tags["{}:{}".format(repository, tag)] = self.id
+
+
+class FakeImages:
+    def __init__(self, tags):
+        self.tags = tags
+
+    def get(self, name):
+        image_id = self.tags.get(name, name)
+        if image_id not in self.tags.values():
+            raise docker.errors.ImageNotFound(name)
+        return FakeImage(self, image_id)
+
+
+class FakeClient:
+    def __init__(self, tags):
+        self.images = FakeImages(tags)
+
+
+def gate_config(tmp_path, endpoint):
+    url = "http://localhost:{}".format(endpoint.server_port)
+    return SimpleNamespace(path=str(tmp_path), upgrade_gate=True,
+                           upgrade_gate_targets={"hint": url},
+                           upgrade_gate_requests=5,
+                           upgrade_gate_max_p95_ratio=1.5,
+                           upgrade_gate_slack_ms=100,
+                           upgrade_gate_max_error_rate=0.05,
+                           docker_endpoints={})
+
+
+def test_percentile():
+    assert hint_upgrade_gate.percentile([3, 1, 2], 95) == 3
+    assert hint_upgrade_gate.percentile(list(range(1, 101)), 95) == 95
+    assert hint_upgrade_gate.percentile([5], 50) == 5
+
+
+def test_gate_breaches():
+    baseline = {"hint": {"p95": 100, "error_rate": 0}}
+    ok = {"hint": {"p95": 240, "error_rate": 0.01}}
+    assert hint_upgrade_gate.gate_breaches(baseline, ok, 1.5, 100, 0.05) == []
+    slow = {"hint": {"p95": 300, "error_rate": 0},
+            "hintr": {"p95": 1000, "error_rate": 0.5}}
+    assert hint_upgrade_gate.gate_breaches(baseline, slow, 1.5, 100, 0.05) \
+        == ["hint p95 300ms exceeds 250ms",
+            "hintr error rate 50% exceeds 5%"]
+
+
+def test_probe_counts_errors(endpoint):
+    url = "http://localhost:{}".format(endpoint.server_port)
+    res = hint_upgrade_gate.probe({"hint": url}, 4)
+    assert res["hint"]["error_rate"] == 0
+    assert res["hint"]["p95"] > 0
+    endpoint.status = 503
+    res = hint_upgrade_gate.probe({"hint": url, "gone": "http://localhost:1"},
+                                  4, timeout=1)
+    assert res["hint"]["error_rate"] == 1
+    assert res["gone"]["error_rate"] == 1
+
+
+def test_image_digests_and_restore():
+    client = FakeClient({"mrcide/hintr:master": "sha256:old"})
+    digests = hint_upgrade_gate.image_digests(
+        ["mrcide/hintr:master", "mrcide/missing:master"], client)
+    assert digests == {"mrcide/hintr:master": "sha256:old"}
+    client.images.tags["mrcide/hintr:master"] = "sha256:new"
+    client.images.tags["other:latest"] = "sha256:old"
+    hint_upgrade_gate.image_restore(digests, client)
+    assert client.images.tags["mrcide/hintr:master"] == "sha256:old"
+
+
+def test_upgrade_gate_passes(tmp_path, endpoint):
+    cfg = gate_config(tmp_path, endpoint)
+    client = FakeClient({"mrcide/hint:master": "sha256:old"})
+    upgrade = mock.Mock()
+    rollback = mock.Mock()
+    hint_upgrade_gate.upgrade_gated(cfg, ["mrcide/hint:master"],
+                                    upgrade, rollback, client)
+    assert upgrade.called
+    assert not rollback.called
+    assert (tmp_path / ".upgrade_baseline.json").exists()
+
+
+def test_upgrade_gate_rolls_back(tmp_path, endpoint):
+    cfg = gate_config(tmp_path, endpoint)
+    client = FakeClient({"mrcide/hint:master": "sha256:old"})
+
+    def upgrade():
+        client.images.tags["mrcide/hint:master"] = "sha256:new"
+        client.images.tags["dangling"] = "sha256:old"
+        endpoint.status = 500
+
+    rollback = mock.Mock()
+    with pytest.raises(Exception, match="failed the latency gate"):
+        hint_upgrade_gate.upgrade_gated(cfg, ["mrcide/hint:master"],
+                                        upgrade, rollback, client)
+    assert rollback.called
+    assert client.images.tags["mrcide/hint:master"] == "sha256:old"
+
+
+def test_upgrade_gate_rolls_back_failed_upgrade(tmp_path, endpoint):
+    cfg = gate_config(tmp_path, endpoint)
+    client = FakeClient({"mrcide/hint:master": "sha256:old"})
+
+    def upgrade():
+        client.images.tags["mrcide/hint:master"] = "sha256:new"
+        client.images.tags["dangling"] = "sha256:old"
+        raise Exception("Hint did not become responsive in time")
+
+    rollback = mock.Mock()
+    with pytest.raises(Exception, match="Hint did not become responsive"):
+        hint_upgrade_gate.upgrade_gated(cfg, ["mrcide/hint:master"],
+                                        upgrade, rollback, client)
+    assert rollback.called
+    assert client.images.tags["mrcide/hint:master"] == "sha256:old"
+
+
+def test_upgrade_gate_rolls_back_remote_endpoints(tmp_path, endpoint):
+    cfg = gate_config(tmp_path, endpoint)
+    client = FakeClient({"mrcide/hintr:master": "sha256:old"})
+    remote = FakeClient({"mrcide/hintr:master": "sha256:old"})
+
+    def upgrade():
+        for x in [client, remote]:
+            x.images.tags["mrcide/hintr:master"] = "sha256:new"
+            x.images.tags["dangling"] = "sha256:old"
+        endpoint.status = 500
+
+    with pytest.raises(Exception, match="failed the latency gate"):
+        hint_upgrade_gate.upgrade_gated(cfg, ["mrcide/hintr:master"],
+                                        upgrade, mock.Mock(), client,
+                                        remote=[remote])
+    assert remote.images.tags["mrcide/hintr:master"] == "sha256:old"
+
+
+def test_upgrade_gate_uses_stored_baseline_if_unhealthy(tmp_path, endpoint):
+    cfg = gate_config(tmp_path, endpoint)
+    stored = {"hint": {"p95": 1, "error_rate": 0}}
+    with open(str(tmp_path / ".upgrade_baseline.json"), "w") as f:
+        f.write('{"hint": {"p95": 1, "error_rate": 0}}')
+    endpoint.status = 500
+    assert hint_upgrade_gate.upgrade_gate_baseline(cfg) == stored
+
+
+def test_upgrade_gate_disabled():
+    cfg = hint_deploy.HintConfig("config")
+    assert not cfg.upgrade_gate
+    upgrade = mock.Mock()
+    hint_upgrade_gate.upgrade_gated(cfg, [], upgrade, None)
+    assert upgrade.called
@@ -1,8 +1,17 @@
 import pytest
 
+from unittest import mock
+
 from src.hint_deploy import wait
 
 
 def test_wait_errors_on_timeout():
     with pytest.raises(Exception, match="my message"):
         wait(lambda: False, "my message", 0.1, 0.1)
+
+
+def test_wait_returns_elapsed_time():
+    f = mock.Mock(side_effect=[False, False, True])
+    elapsed = wait(f, "not ready", poll=0.01)
+    assert f.call_count == 3
+    assert elapsed >= 0.02